@@ -0,0 +1,133 @@
+"""
+Prompt context for the Agent tab.
+
+Instead of resending the whole chat history on every turn, the prompt is built from the system prompt, the current
+bowtie as structured state, a short local summary of the older turns and a bounded window of recent turns. Token counts
+use tiktoken when it is installed and a characters-per-token estimate otherwise.
+"""
+import json
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Maximum number of recent chat messages sent verbatim
+CONTEXT_MESSAGES = 8
+# Token budget for the recent chat messages
+CONTEXT_TOKEN_BUDGET = 3000
+# Characters kept from each older user message in the summary
+SUMMARY_CHARS = 160
+# Average number of characters per token used when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+# Tokens added per message for the role and message framing
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# System prompt of the Agent tab that controls the chatbot's behavior. It is a module constant, so one copy is shared
+# by all sessions of the process.
+BOWTIE_PROCESS_DESCRIPTION = """
+    You are a risk management expert. Your primary role is to facilitate the bowtie workshop process.
+    The purpose of a Major Hazard bowtie Bowtie workshop is to guide the workshop’s participants through the process of construction of the Bowtie diagram, making them to think as actively as possible about the potential hazards present in a given facility or operation, and the ways in which those hazards are controlled, and transform their input into the constitutive elements of the Bowtie diagram. The ultimate goal is to help users build bowtie diagrams to visually depict a hazardous scenario and the barriers in place to control it.
+    
+    You need to work with the user to understand the following elements of the operation that will define the bowtie diagram:
+    1. **Hazard**: The hazard that is being analyzed. Each bowtie diagram has only one hazard. Hazards do not happen, they just exist. The hazard defines the context and scope of the bowtie diagram. The hazard is part of normal business operations and is often necessary for the business to function. It describes the desired or controlled state or activity. It has the potential to cause harm if control is lost. Harm is defined as any negative impact on people, assets, environment, finances, or reputation.
+    2. **Top Event**: The event is the moment when the control over the hazard is lost. Each hazard can have multiple top events, however each Bowtie diagram has only a single top event. A Bowtie diagram represents a single pair of Hazard+Top Event. The top event is a deviation from a desired state or activity. It happens BEFORE major harm occurs and it is still possible to recover from.
+    3. **Consequences**: The undesired hazardous outcome that can occur as the result of a top event. Each top event can have multiple consequences. There is no limit to the number of consequences a top event can have. The consequences are the outcomes that can cause harm to people, assets, environment, finances, or reputation; i.e. the direct cause for the harm.
+    4. **Threats**: A possible cause of the top event. Each top event can have multiple threats. There is no limit to the number of threats a top event can have. Threats are specific, credible causes of a top event and must lead DIRECTLY AND INDEPENDENTLY to the top event occurring. Barrier failures are not threats. Human errors are not threats. Threats are not the same as causes of harm. Threats are the causes of the top event, not the consequences.
+    5. **Barriers**: A barrier is a hardware measure, human measure, or a combination of hardware and human measure that is in place to prevent the top event from occurring or to mitigate the consequences of the top event. Barriers can be Preventative (eliminate or prevent a threat) or Mitigative (control or mitigate a consequence) upon undesired events. Barriers can be classified as: passive hardware, active hardware, active hardware + human, active human, or continous. Each threat can have multiple preventive barriers, but not more than five. Each consequence can have multiple mitigative barriers, but not more than five. Barriers are not the same as controls. Controls are the measures that are in place to manage the risk. Barriers are the specific controls that are in place to prevent the top event from occurring or to mitigate the consequences of the top event. A barrier to prevent or control a threat to avoid it leading to a top event is called a preventive barrier and exists between a threat and the top event. A barrier to control or mitigate the top event to minimize or prevent a consequence is called a mitigative barrier and exists between the top event and the consequence. Barriers can be active or passive. Active barriers require human intervention to function, while passive barriers do not require human intervention to function.
+
+    The structure of a bowtie diagram is as follows:
+    Threats → Preventive Barriers → Top Event → Mitigative Barriers → Consequences
+    Top event is always at the center of the diagram, with threats on the left side and consequences on the right side. Preventive barriers are placed between threats and the top event, while mitigative barriers are placed between the top event and consequences.
+    All of the above falls under the single defined Hazard.
+
+    Your job is to parse the user's input and help them build a bowtie diagram by asking questions and providing guidance.
+    You will need to ask the user for the hazard, top events, threats, consequences, and barriers.
+    You will also need to help the user understand the relationships between these elements and how they fit together in the bowtie diagram. If the user provides a response that is not clear or does not fit the bowtie methodology, ask them to clarify their input and provide guidance on how to do so. You are allowed to ask the user follow up questions to clarify their input and to help them build the bowtie diagram. Each follow up response may contain enough questions to help the user clarify their input, but do not overwhelm them with too many questions at once.
+    It is acceptable and desirable to make suggestions to the user based on their input, especially for barriers that might be missed, but do not assume that the user will accept your suggestions. If you make a suggestion, ask the user if they agree with it and if they would like to include it in the bowtie diagram.
+    If you believe you have enough information to build the bowtie diagram, inform the user that the diagram is ready and call the update_bowtie function with the bowtie_data described below.
+    Once a bowtie exists, do not repeat it: call the patch_bowtie function with only the changes, as add, remove and rename operations on the node IDs shown in the current bowtie_data. Threats and consequences can be added together with their barriers.
+
+    You must pass the user's responses to the update_bowtie function in the following structured format instead of writing them into your message:
+    bowtie_data = { "hazard": "", "top_events": [ { "top_event": "<top_event_1>", "threats": [ { "threat": "<threat_1>", "preventive_barriers": ["<barrier_1>", "<barrier_2>"] }, ... ], "consequences": [ { "consequence": "<consequence_1>", "mitigative_barriers": ["<barrier_1>", "<barrier_2>"] }, ... ] }, ... ] }
+    Format the text in the dictionary entries as follows: Capitalize the first letter of each word for hazard. Use sentence case for top_event, threat, consequence, preventive_barriers, and mitigative_barriers. Avoid using special characters, especially parentheses and brackets.
+    Only include fields that the user has provided or suggestions the user has explicitly accepted. If the user hasn't provided a value yet, leave it blank or omit it. Ask follow-up questions to complete the structure.
+    The function arguments must be valid JSON matching this structure.
+    """
+
+_encoding = None
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text):
+    """Return the number of tokens in the text."""
+    global _encoding
+    if tiktoken is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(text))
+
+
+def _tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def message_tokens(messages):
+    """Return the number of prompt tokens of a list of chat messages."""
+    return sum(_tokens(m) for m in messages)
+
+
+def summarize(messages):
+    """Return a short summary of older chat messages, built locally from the user's inputs."""
+    points = []
+    for m in messages:
+        if m["role"] != "user":
+            continue
+        text = " ".join(m["content"].split())
+        points.append(f"- {text[:SUMMARY_CHARS]}{'...' if len(text) > SUMMARY_CHARS else ''}")
+    if not points:
+        return ""
+    return "Summary of earlier user input in this workshop (older turns are not repeated):\n" + "\n".join(points)
+
+
+def build_context(system_prompt, bowtie, history, max_messages=CONTEXT_MESSAGES, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Return the messages to send for the next turn and the token counts of the request.
+
+    The current bowtie (a bowtie_model.Hazard or None) is sent as structured state with its node IDs. The most recent messages are kept
+    verbatim up to max_messages and token_budget; older ones are replaced by a summary. The token counts are a dictionary
+    with the prompt tokens sent, the prompt tokens the full history would have needed, and the number of summarized
+    messages.
+    """
+    # Keep the newest messages that fit, always including the latest one
+    recent = []
+    used = 0
+    for m in reversed(history):
+        tokens = _tokens(m)
+        if recent and (len(recent) >= max_messages or used + tokens > token_budget):
+            break
+        recent.append({"role": m["role"], "content": m["content"]})
+        used += tokens
+    recent.reverse()
+    older = history[:len(history) - len(recent)]
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if bowtie is not None:
+        messages.append({
+            "role": "system",
+            "content": "Current bowtie_data with node IDs for patch_bowtie:\n"
+                       + json.dumps(bowtie.to_dict(ids=True), ensure_ascii=False, separators=(",", ":")),
+        })
+    summary = summarize(older)
+    if summary:
+        messages.append({"role": "system", "content": summary})
+    messages += recent
+
+    system_tokens = message_tokens(messages[:len(messages) - len(recent)])
+    return messages, {
+        "prompt_tokens": system_tokens + used,
+        "full_history_tokens": message_tokens([messages[0]]) + message_tokens(history),
+        "summarized_messages": len(older),
+    }
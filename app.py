@@ -1,13 +1,28 @@
 import os
-import matplotlib.pyplot as plt
-import io
+import copy
+import functools
+import time
+from concurrent.futures import wait
 os.environ["STREAMLIT_WATCHDOG_TYPE"] = "poll"
 import streamlit as st
 import pandas as pd
-from openai import OpenAI
-import ast
+import openai
 import json
 import streamlit_mermaid as stmd
+from bowtie_model import Hazard, TopEvent, Threat, Consequence, Barrier, Workspace
+from excel_io import STREAM_ROW_LIMIT, export_excel, import_excel, import_workbook, stream_excel
+from bowtie_export import EXPORT_FORMATS, export_bowtie
+from bowtie_store import NODE_KINDS, store_from_env
+from barrier_canon import canonical_renames
+from agent_context import BOWTIE_PROCESS_DESCRIPTION, build_context, count_tokens
+from bowtie_extraction import AGENT_TOOLS, BowtieExtractor
+from llm_client import LLMConfig, get_client, stream_chat
+from response_cache import response_cache_from_env
+from mermaid_emitter import build_mermaid_code, branch_cache_info
+from profiling import Profiler, StreamTimer, cache_stats
+from thumbnails import thumbnails_from_env
+from shared_cache import process_memory, report_session, session_reports, shared_caches
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Set custom page configuration including the "About" section
 st.set_page_config(
@@ -23,7 +38,7 @@ st.set_page_config(
     }
 )
 
-# Initialize session state variables:
+# Initialize session state variables. Both hold a bowtie_model.Hazard shared by all tabs:
 # to store bowtie data generated by the agent or uploaded by the user
 if "bowtie_data" not in st.session_state:
     st.session_state.bowtie_data = None
@@ -31,41 +46,97 @@ if "bowtie_data" not in st.session_state:
 if "diagram_data" not in st.session_state:
     st.session_state.diagram_data = None
 
+# Bowties with more nodes than this open in the single branch editor of the Inputs tab
+LARGE_BOWTIE_NODES = 60
+
+# Maximum number of library bowties listed in the Data tab
+LIBRARY_PAGE_SIZE = 50
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Previews per gallery page and per row, and seconds a gallery page waits for missing previews before showing placeholders
+GALLERY_PAGE_SIZE = 12
+GALLERY_COLUMNS = 4
+GALLERY_WAIT = 1.0
+
+# Longest side in pixels of the Matplotlib image shown in the PDF tab
+PREVIEW_PIXELS = 4000
+
+# Placeholder bowtie used by the Inputs tab when no bowtie data exists yet
+EMPTY_BOWTIE = {
+    "hazard": "Enter the hazard here",
+    "top_events": [
+        {
+            "top_event": "Enter Top Event 1 here",
+            "threats": [{"threat": "Enter Threat 1 here", "preventive_barriers": ["Enter Preventive Barrier 1 here"]}],
+            "consequences": [{"consequence": "Enter Consequence 1 here", "mitigative_barriers": ["Enter Mitigative Barrier 1 here"]}],
+        }
+    ],
+}
+
+# Mark the start of a full script run. Each tab is a fragment that reruns on its own when the user interacts with it,
+# so this flag is only set while the whole script is running.
+st.session_state.full_run = True
+
+# Timing spans of this session, shown in the debug panel of the Inputs tab. Fragment reruns are recorded as their own runs.
+if "profiler" not in st.session_state:
+    st.session_state.profiler = Profiler()
+st.session_state.profiler.start_run("full")
+
+
+def span(name):
+    """Time the enclosed code as a span of the current run."""
+    return st.session_state.profiler.span(name)
+
+
+def profiled(name):
+    """Decorate a function so that every call is timed as a span."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def publish(name, value, rerun=True):
+    """
+    Store bowtie data shared between tabs in session state.
+
+    When the content changed during a fragment rerun, the whole app is rerun so that the tabs depending on it are
+    recomputed, unless rerun is False because the caller reruns the dependent tabs itself. During a full run, the tabs
+    further down the script pick up the new value directly.
+    """
+    value_hash = value.content_hash() if value is not None else None
+    changed = st.session_state.get(f"{name}_hash", "") != value_hash
+    st.session_state[name] = value
+    st.session_state[f"{name}_hash"] = value_hash
+    if changed and rerun and not st.session_state.full_run:
+        st.rerun()
+
+
+def edited():
+    """
+    Callback of the editor widgets of the Inputs tab. An edit only changes diagram_data, so instead of the whole app
+    only the Inputs tab, which rebuilds diagram_data, and the Diagram and PDF tabs showing it are rerun, in that order.
+    """
+    st.rerun(scope=["inputs", "diagram", "pdf"])
+
+
+# to store the library ID of the open bowtie, None until it is saved to or opened from the library
+if "library_id" not in st.session_state:
+    st.session_state.library_id = None
+
 # Dashboard title
 st.title("Bowtie Builder")
 
 tab1, tab2, tab3, tab4, tab5 = st.tabs(["Agent", "Data", "Inputs", "Diagram","PDF"])
-with tab1:
-    # Define the bowtie process description and prompt to control the chatbot's behavior
-    bowtie_process_description = """
-    You are a risk management expert. Your primary role is to facilitate the bowtie workshop process.
-    The purpose of a Major Hazard bowtie Bowtie workshop is to guide the workshop’s participants through the process of construction of the Bowtie diagram, making them to think as actively as possible about the potential hazards present in a given facility or operation, and the ways in which those hazards are controlled, and transform their input into the constitutive elements of the Bowtie diagram. The ultimate goal is to help users build bowtie diagrams to visually depict a hazardous scenario and the barriers in place to control it.
-    
-    You need to work with the user to understand the following elements of the operation that will define the bowtie diagram:
-    1. **Hazard**: The hazard that is being analyzed. Each bowtie diagram has only one hazard. Hazards do not happen, they just exist. The hazard defines the context and scope of the bowtie diagram. The hazard is part of normal business operations and is often necessary for the business to function. It describes the desired or controlled state or activity. It has the potential to cause harm if control is lost. Harm is defined as any negative impact on people, assets, environment, finances, or reputation.
-    2. **Top Event**: The event is the moment when the control over the hazard is lost. Each hazard can have multiple top events, however each Bowtie diagram has only a single top event. A Bowtie diagram represents a single pair of Hazard+Top Event. The top event is a deviation from a desired state or activity. It happens BEFORE major harm occurs and it is still possible to recover from.
-    3. **Consequences**: The undesired hazardous outcome that can occur as the result of a top event. Each top event can have multiple consequences. There is no limit to the number of consequences a top event can have. The consequences are the outcomes that can cause harm to people, assets, environment, finances, or reputation; i.e. the direct cause for the harm.
-    4. **Threats**: A possible cause of the top event. Each top event can have multiple threats. There is no limit to the number of threats a top event can have. Threats are specific, credible causes of a top event and must lead DIRECTLY AND INDEPENDENTLY to the top event occurring. Barrier failures are not threats. Human errors are not threats. Threats are not the same as causes of harm. Threats are the causes of the top event, not the consequences.
-    5. **Barriers**: A barrier is a hardware measure, human measure, or a combination of hardware and human measure that is in place to prevent the top event from occurring or to mitigate the consequences of the top event. Barriers can be Preventative (eliminate or prevent a threat) or Mitigative (control or mitigate a consequence) upon undesired events. Barriers can be classified as: passive hardware, active hardware, active hardware + human, active human, or continous. Each threat can have multiple preventive barriers, but not more than five. Each consequence can have multiple mitigative barriers, but not more than five. Barriers are not the same as controls. Controls are the measures that are in place to manage the risk. Barriers are the specific controls that are in place to prevent the top event from occurring or to mitigate the consequences of the top event. A barrier to prevent or control a threat to avoid it leading to a top event is called a preventive barrier and exists between a threat and the top event. A barrier to control or mitigate the top event to minimize or prevent a consequence is called a mitigative barrier and exists between the top event and the consequence. Barriers can be active or passive. Active barriers require human intervention to function, while passive barriers do not require human intervention to function.
-
-    The structure of a bowtie diagram is as follows:
-    Threats → Preventive Barriers → Top Event → Mitigative Barriers → Consequences
-    Top event is always at the center of the diagram, with threats on the left side and consequences on the right side. Preventive barriers are placed between threats and the top event, while mitigative barriers are placed between the top event and consequences.
-    All of the above falls under the single defined Hazard.
-
-    Your job is to parse the user's input and help them build a bowtie diagram by asking questions and providing guidance.
-    You will need to ask the user for the hazard, top events, threats, consequences, and barriers.
-    You will also need to help the user understand the relationships between these elements and how they fit together in the bowtie diagram. If the user provides a response that is not clear or does not fit the bowtie methodology, ask them to clarify their input and provide guidance on how to do so. You are allowed to ask the user follow up questions to clarify their input and to help them build the bowtie diagram. Each follow up response may contain enough questions to help the user clarify their input, but do not overwhelm them with too many questions at once.
-    It is acceptable and desirable to make suggestions to the user based on their input, especially for barriers that might be missed, but do not assume that the user will accept your suggestions. If you make a suggestion, ask the user if they agree with it and if they would like to include it in the bowtie diagram.
-    If you believe you have enough information to build the bowtie diagram, inform the user that the diagram is ready and output the bowtie_data dictionary as described below.
-
-    You must output the user's responses in the following structured dictionary format:
-    bowtie_data = { "hazard": "", "top_events": [ { "top_event": "<top_event_1>", "threats": [ { "threat": "<threat_1>", "preventive_barriers": ["<barrier_1>", "<barrier_2>"] }, ... ], "consequences": [ { "consequence": "<consequence_1>", "mitigative_barriers": ["<barrier_1>", "<barrier_2>"] }, ... ] }, ... ] }
-    Format the text in the dictionary entries as follows: Capitalize the first letter of each word for hazard. Use sentence case for top_event, threat, consequence, preventive_barriers, and mitigative_barriers. Avoid using special characters, especially parentheses and brackets.
-    Only include fields that the user has provided or suggestions the user has explicitly accepted. If the user hasn't provided a value yet, leave it blank or omit it. Ask follow-up questions to complete the structure.
-    The output should be a valid Python dictionary that can be parsed using `ast.literal_eval()`.
-    """
 
+
+@st.fragment(key="agent")
+@profiled("agent")
+def agent_tab():
     # Create title and description
     st.header(":material/robot_2: Bowtie Facilitation Agent")
     st.write(
@@ -80,8 +151,16 @@ with tab1:
     
     # Once OpenAI API key is provided, initialize the chatbot.
     else:
-        # Create an OpenAI client.
-        client = OpenAI(api_key=openai_api_key)
+        # Get the OpenAI client. Clients are cached per API key, so connections are reused across reruns.
+        llm_config = LLMConfig.from_env()
+        client = get_client(openai_api_key, llm_config)
+
+        # Optional on-disk cache of replies to repeated prompts, configured by BOWTIE_RESPONSE_CACHE_* variables
+        response_cache = response_cache_from_env()
+        use_response_cache = response_cache is not None and st.toggle(
+            "Reuse cached replies", value=True, key="use_response_cache",
+            help="Answer prompts that were asked before with the same bowtie and history from the response cache.",
+        )
 
         # Create a session state variable to store the chat messages. This ensures that the messages persist across reruns.
         if "messages" not in st.session_state:
@@ -100,90 +179,164 @@ with tab1:
                 #with st.chat_message("user"):
                 #    st.markdown(prompt)
 
-                # Generate a response using the OpenAI API.
-                stream = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": bowtie_process_description},
-                        *[
-                        {"role": m["role"], "content": m["content"]}
-                        for m in st.session_state.messages
-                        ]
-                    ],
-                    stream=True,
+                # Build the prompt from the current bowtie and a bounded window of recent turns instead of the whole history
+                with span("agent.context"):
+                    messages, context_stats = build_context(
+                        BOWTIE_PROCESS_DESCRIPTION, st.session_state.bowtie_data, st.session_state.messages
+                    )
+
+                # Generate a response using the OpenAI API. The request runs on a worker thread with timeouts and retries.
+                # The bowtie or a patch to it comes back as function call arguments, collected while the reply streams.
+                # Repeated prompts are answered from the response cache when it is configured and enabled.
+                # The timer measures the time to the first text or function call chunk for the debug panel.
+                usage = {}
+                extractor = BowtieExtractor()
+                timer = StreamTimer()
+
+                def on_tool_call(index, name, arguments):
+                    timer.mark()
+                    extractor.feed_arguments(index, name, arguments)
+
+                request = dict(
+                    on_usage=lambda u: usage.update(prompt_tokens=u.prompt_tokens, completion_tokens=u.completion_tokens),
+                    on_tool_call=on_tool_call,
+                    tools=AGENT_TOOLS,
                 )
+                if use_response_cache:
+                    stream, cached = response_cache.stream_chat(client, messages, llm_config, **request)
+                else:
+                    stream, cached = stream_chat(client, messages, llm_config, **request), False
 
                 # Stream the response to the chat using `st.write_stream`, then store it in session state.
-                with st.chat_message("assistant"):
-                    response = st.write_stream(stream)
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                try:
+                    with span("agent.reply"), st.chat_message("assistant"):
+                        response = st.write_stream(extractor.watch(timer.watch(stream)))
+                except openai.OpenAIError as e:
+                    st.error(f"❌ The OpenAI request failed: {e}")
+                    response = ""
+                # Count the reply tokens locally when the API does not report them, e.g. for cached replies
+                st.session_state.profiler.record_llm(
+                    timer, usage.get("completion_tokens") or count_tokens(response or "") or None, cached
+                )
+                # A reply may consist of the function call only
+                if not response and extractor.found:
+                    response = "The bowtie diagram has been updated."
+                if response:
+                    st.session_state.messages.append({"role": "assistant", "content": response})
+
+                # Keep the prompt size of the last request, with the tokens the API counted when it reports them
+                st.session_state.last_request_tokens = (
+                    f"Last request: {usage.get('prompt_tokens', context_stats['prompt_tokens']):,} prompt tokens "
+                    f"(full history: {context_stats['full_history_tokens']:,} tokens, "
+                    f"{context_stats['summarized_messages']} older messages summarized)"
+                    + (f" | {usage['completion_tokens']:,} reply tokens" if "completion_tokens" in usage else "")
+                    + (" | cached reply" if cached else "")
+                )
 
-                if "bowtie_data" in response:
+                if extractor.found:
                     try:
-                        # Extract the dictionary from the response
-                        start = response.find("bowtie_data =")
-                        code_block = response[start:].split("```")[0]
-                        code = code_block.replace("bowtie_data =", "").strip()
-                        st.session_state.bowtie_data = ast.literal_eval(code)
-                    except Exception as e:
+                        # The stored bowtie only changes when every call of the reply applies
+                        publish("bowtie_data", extractor.apply(st.session_state.bowtie_data))
+                    except ValueError as e:
                         st.warning(f"Could not parse bowtie_data: {e}")
 
         with column2:
             st.subheader("Chat History (newest message at the top)")
+            if "last_request_tokens" in st.session_state:
+                st.caption(st.session_state.last_request_tokens)
+            if response_cache is not None:
+                response_stats = response_cache.stats()
+                st.caption(f"Response cache: {response_stats['hits']} hits, {response_stats['misses']} misses, "
+                           f"{response_stats['entries']} stored replies")
             # Display the existing chat messages via `st.chat_message`.
             for message in reversed(st.session_state.messages):
                 with st.chat_message(message["role"]):
                     st.markdown(message["content"])
-with tab2:
+
+
+with tab1:
+    agent_tab()
+
+
+@st.fragment(key="data")
+@profiled("data")
+def data_tab():
     st.header(":material/analytics: Bowtie Data")
+    store = store_from_env()
+    thumbnails = thumbnails_from_env()
+
+    def save_bowtie(bowtie, bowtie_id=None, messages=None):
+        # Bowties get their gallery preview rendered in the background when they are saved to the library
+        library_id = store.save(bowtie, bowtie_id, messages)
+        thumbnails.submit(bowtie)
+        return library_id
+
     st.divider()
     st.subheader(":material/upload: Import From Excel")
-    st.write("Upload an Excel file with `Threats`, `Consequences`, and optionally `Info` sheets.")
+    st.write("Upload an Excel file with `Threats`, `Consequences`, and optionally `Info` sheets. Further top events and bowties follow as numbered sheet sets (`Threats 2`, ...), as written by the Excel export.")
 
     excel_file = st.file_uploader("Upload Excel File", type=["xlsx"], key="excel_uploader")
+    # Streaming mode reads the workbook row by row to keep memory bounded on very large barrier registers
+    stream_import = st.toggle("Streaming import for large files", key="excel_stream", help="Read the workbook row by row instead of loading it into memory at once.")
+    if stream_import:
+        stream_row_limit = st.number_input("Row Limit", min_value=1, value=STREAM_ROW_LIMIT, step=1000, key="excel_row_limit", help="Maximum number of threat and consequence rows to import.")
     if excel_file:
         try:
-            df_threats = pd.read_excel(excel_file, sheet_name="Threats")
-            df_conseq = pd.read_excel(excel_file, sheet_name="Consequences")
-
-            try:
-                df_info = pd.read_excel(excel_file, sheet_name="Info", header=None)
-                hazard = str(df_info.iloc[0, 1]) if not pd.isna(df_info.iloc[0, 1]) else "Enter the hazard here"
-                top_event = str(df_info.iloc[1, 1]) if not pd.isna(df_info.iloc[1, 1]) else "Enter the top event here"
-            except Exception:
+            if stream_import:
+                # Stream the workbook once per upload and row limit, and keep the result for later reruns
+                stream_key = (excel_file.file_id, stream_row_limit)
+                if st.session_state.get("excel_stream_key") != stream_key:
+                    progress_bar = st.progress(0, text="Reading workbook...")
+                    with span("data.excel_stream"):
+                        st.session_state.excel_stream = stream_excel(
+                            excel_file,
+                            max_rows=stream_row_limit,
+                            progress=lambda rows: progress_bar.progress(min(rows / stream_row_limit, 1.0), text=f"Read {rows} rows"),
+                        )
+                    st.session_state.excel_stream_key = stream_key
+                    progress_bar.empty()
+                imported = copy.deepcopy(st.session_state.excel_stream)
+                hazard, top_event = imported.name, imported.top_events[0].name
+            else:
+                # Parse all sheets in one pass. The result is cached on the file contents, so reruns do not parse it again.
+                with span("data.excel_import"):
+                    imported = import_excel(excel_file.getvalue())
+                hazard, top_event = imported["hazard"], imported["top_events"][0]["top_event"]
+
+            # Without an Info sheet, ask the user for the hazard and top event
+            if hazard is None:
                 hazard = st.text_input("Hazard", value="Enter the hazard here", key="excel_hazard")
                 top_event = st.text_input("Top Event", value="Enter the top event here", key="excel_top_event")
 
-            threats = [
-                {
-                    "threat": str(row["Threat"]),
-                    "preventive_barriers": [str(b).strip() for b in str(row["Preventive Barriers"]).split(";") if b.strip()]
-                } for _, row in df_threats.iterrows()
-            ]
-
-            consequences = [
-                {
-                    "consequence": str(row["Consequence"]),
-                    "mitigative_barriers": [str(b).strip() for b in str(row["Mitigative Barriers"]).split(";") if b.strip()]
-                } for _, row in df_conseq.iterrows()
-            ]
-
-            bowtie_data_from_excel = {
-                "hazard": hazard,
-                "top_events": [
-                    {
-                        "top_event": top_event,
-                        "threats": threats,
-                        "consequences": consequences
-                    }
-                ]
-            }
+            bowtie_data_from_excel = imported if stream_import else Hazard.from_dict(imported)
+            bowtie_data_from_excel.name = hazard or "Enter the hazard here"
+            bowtie_data_from_excel.top_events[0].name = top_event or "Enter the top event here"
+            # Further sheet sets without their own Info sheet have no top event name either
+            for later in bowtie_data_from_excel.top_events[1:]:
+                later.name = later.name or "Enter the top event here"
 
-            st.session_state.bowtie_data = bowtie_data_from_excel
-            st.session_state.diagram_data = bowtie_data_from_excel
+            # Only replace the current bowtie when the upload or its inputs changed, so bowties opened from the library
+            # are not overwritten on every rerun
+            import_key = (excel_file.file_id, stream_import, hazard, top_event)
+            if st.session_state.get("excel_import_key") != import_key:
+                st.session_state.excel_import_key = import_key
+                # Add the import to the library, so it is indexed for search; new inputs for the same file add versions
+                excel_library_ids = st.session_state.setdefault("excel_library_ids", {})
+                excel_library_ids[excel_file.file_id] = save_bowtie(
+                    bowtie_data_from_excel, excel_library_ids.get(excel_file.file_id)
+                )
+                st.session_state.library_id = excel_library_ids[excel_file.file_id]
+                if not stream_import:
+                    # Further bowties of a workbook with several bowties are added to the library as well
+                    for other in import_workbook(excel_file.getvalue())[1:]:
+                        other["hazard"] = other["hazard"] or "Enter the hazard here"
+                        for other_top_event in other["top_events"]:
+                            other_top_event["top_event"] = other_top_event["top_event"] or "Enter the top event here"
+                        save_bowtie(Hazard.from_dict(other))
+                publish("bowtie_data", bowtie_data_from_excel)
 
             st.success("✅ Bowtie data successfully imported from Excel.")
-            st.json(bowtie_data_from_excel)
+            st.json(bowtie_data_from_excel.to_dict())
 
         except Exception as e:
             st.error("❌ Failed to process Excel file.")
@@ -191,184 +344,529 @@ with tab2:
 
     st.divider()
     st.subheader(":material/save: Import from Json")
-    st.write("You may upload a JSON file containing bowtie data to use in this app instead of using the chat agent.")
+    st.write("You may upload a JSON file containing bowtie data, or a workspace of several bowties, to use in this app instead of using the chat agent.")
     uploaded_file = st.file_uploader(label=":material/upload: Upload Bowtie JSON", type="json")
     if uploaded_file is not None:
         try:
-            uploaded_data = json.load(uploaded_file)
-            st.session_state.bowtie_data = uploaded_data
+            # Load each upload once, so bowties opened from the library are not overwritten on every rerun
+            if st.session_state.get("json_import_key") != uploaded_file.file_id:
+                with span("data.json_load"):
+                    uploaded_data = json.load(uploaded_file)
+                if isinstance(uploaded_data, dict) and "bowties" in uploaded_data:
+                    # A workspace file is added to the library, and its first bowtie is opened. Imports are indexed for search.
+                    workspace = Workspace.from_dict(uploaded_data)
+                    library_ids = [save_bowtie(hazard) for hazard in workspace.hazards]
+                    st.session_state.library_id = library_ids[0] if library_ids else None
+                    uploaded_bowtie = workspace.hazards[0] if workspace.hazards else None
+                else:
+                    uploaded_bowtie = Hazard.from_dict(uploaded_data)
+                    st.session_state.library_id = save_bowtie(uploaded_bowtie)
+                st.session_state.json_import_key = uploaded_file.file_id
+                publish("bowtie_data", uploaded_bowtie)
             st.success("✅ bowtie_data has been successfully loaded from the uploaded file.")
         except Exception as e:
             st.error(f"❌ Failed to load JSON: {e}")
 
+    st.divider()
+    st.subheader(":material/folder_open: Library")
+    st.write("Save bowties to the local library with their versions and chat history, and open them again in any session.")
+
+    def save_to_library():
+        # Save the edited diagram as a new version of the bowtie it was opened from, or as a new bowtie
+        bowtie = st.session_state.diagram_data or st.session_state.bowtie_data
+        st.session_state.library_id = save_bowtie(
+            bowtie, st.session_state.library_id, st.session_state.get("messages", [])
+        )
+
+    def new_in_library():
+        # Start a new, empty bowtie with an empty chat. The edited copy is cleared too, so Save does not store the old
+        # bowtie again, and the whole app reruns because the other tabs still show it
+        st.session_state.library_id = None
+        st.session_state.bowtie_data = None
+        st.session_state.bowtie_data_hash = None
+        st.session_state.diagram_data = None
+        st.session_state.diagram_data_hash = None
+        st.session_state.messages = []
+        st.rerun(scope="app")
+
+    # Only the summaries of the matching bowties are read; a bowtie is loaded when it is opened
+    hazard_column, top_event_column = st.columns(2)
+    with hazard_column:
+        hazard_filter = st.text_input("Hazard starts with", key="library_hazard_filter")
+    with top_event_column:
+        top_event_filter = st.text_input("Top event starts with", key="library_top_event_filter")
+    with span("data.library_list"):
+        matches = {b["id"]: b for b in store.list_bowties(hazard_filter, top_event_filter, limit=LIBRARY_PAGE_SIZE)}
+    library_id = st.session_state.library_id
+
+    library_column, version_column, open_column, save_column, new_column = st.columns(
+        [4, 2, 1, 1, 1], vertical_alignment="bottom"
+    )
+    with library_column:
+        library_choice = st.selectbox(
+            "Bowtie",
+            options=list(matches),
+            format_func=lambda i: f"{matches[i]['hazard']} | {matches[i]['top_event_count']} top event(s) | "
+                                  f"version {matches[i]['version']}",
+            index=list(matches).index(library_id) if library_id in matches else None,
+            placeholder="No saved bowties match" if library_id is None else "Open bowtie not in this list",
+        )
+    with version_column:
+        versions = store.versions(library_choice) if library_choice is not None else []
+        version_choice = st.selectbox(
+            "Version",
+            options=[v["version"] for v in versions],
+            format_func=lambda v: f"{v} of {versions[0]['version']}",
+            disabled=not versions,
+        )
+    with open_column:
+        open_clicked = st.button("Open", icon=":material/open_in_new:", disabled=library_choice is None, width="stretch")
+    with save_column:
+        st.button("Save", icon=":material/save:", on_click=save_to_library,
+                  disabled=st.session_state.diagram_data is None and st.session_state.bowtie_data is None, width="stretch")
+    with new_column:
+        st.button("New", icon=":material/add:", on_click=new_in_library, width="stretch")
+    st.caption(f"Showing {len(matches)} of {store.count(hazard_filter, top_event_filter)} matching bowties"
+               + (f", open bowtie: #{library_id}" if library_id is not None else ""))
+    if matches:
+        st.download_button(
+            label="Save Listed Bowties as Workspace",
+            # Built only when clicked, so listing the library never loads the bowties
+            data=lambda: json.dumps(Workspace([store.load(i) for i in matches]).to_dict(), indent=4),
+            file_name="bowtie_workspace.json",
+            mime="application/json",
+            icon=":material/download:",
+            on_click="ignore",
+        )
+        st.download_button(
+            label="Save Listed Bowties as Excel",
+            data=lambda: export_excel(store.load(i) for i in matches),
+            file_name="bowtie_workspace.xlsx",
+            mime=XLSX_MIME,
+            icon=":material/download:",
+            on_click="ignore",
+        )
+    if open_clicked:
+        st.session_state.library_id = library_choice
+        st.session_state.messages = store.load_messages(library_choice)
+        publish("bowtie_data", store.load(library_choice, version_choice))
+
+    st.divider()
+    st.subheader(":material/photo_library: Gallery")
+    st.write("Browse previews of the bowties matching the library filters above.")
+    # Previews are rendered in the background when bowties are saved, and stored by content. Only the bowties of the
+    # current page are read, and those without a preview yet are queued for rendering unless their render failed.
+    gallery_pages = max(-(-store.count(hazard_filter, top_event_filter) // GALLERY_PAGE_SIZE), 1)
+    # Keep the page within range when the filters leave fewer pages
+    st.session_state.gallery_page = min(st.session_state.get("gallery_page", 1), gallery_pages)
+    gallery_page = st.number_input(f"Page (of {gallery_pages})", min_value=1, max_value=gallery_pages, step=1, key="gallery_page")
+    with span("data.gallery"):
+        page = store.list_bowties(hazard_filter, top_event_filter, limit=GALLERY_PAGE_SIZE, offset=(gallery_page - 1) * GALLERY_PAGE_SIZE)
+        renders = [
+            thumbnails.submit(store.load(s["id"])) for s in page
+            if thumbnails.get(s["content_hash"]) is None and not thumbnails.failed(s["content_hash"])
+        ]
+        wait([r for r in renders if r is not None], timeout=GALLERY_WAIT)
+    for row in range(0, len(page), GALLERY_COLUMNS):
+        for summary, column in zip(page[row:row + GALLERY_COLUMNS], st.columns(GALLERY_COLUMNS)):
+            with column:
+                preview = thumbnails.get(summary["content_hash"])
+                if preview is not None:
+                    st.image(preview, width="stretch")
+                elif thumbnails.failed(summary["content_hash"]):
+                    st.warning("Preview unavailable", icon=":material/broken_image:")
+                else:
+                    st.info("Rendering preview...", icon=":material/hourglass_empty:")
+                st.caption(f"#{summary['id']} {summary['hazard']} | {summary['node_count']} elements | version {summary['version']}")
+                if st.button("Open", key=f"gallery_open_{summary['id']}", icon=":material/open_in_new:"):
+                    st.session_state.library_id = summary["id"]
+                    st.session_state.messages = store.load_messages(summary["id"])
+                    publish("bowtie_data", store.load(summary["id"]))
+    if not page:
+        st.info("No saved bowties match the filters.")
+    elif thumbnails.pending():
+        st.button("Refresh Previews", icon=":material/refresh:", key="gallery_refresh")
+
+    st.divider()
+    st.subheader(":material/search: Search Library")
+    st.write("Find hazards, top events, threats, consequences and barriers across all bowties in the library.")
+    search_column, kind_column = st.columns([3, 2])
+    with search_column:
+        search_text = st.text_input("Search", key="library_search", placeholder="e.g. emergency shut")
+    with kind_column:
+        search_kinds = st.multiselect(
+            "Element types", options=list(NODE_KINDS.values()), key="library_search_kinds",
+            format_func=lambda kind: kind.replace("_", " ").capitalize(),
+        )
+    if search_text:
+        with span("data.library_search"):
+            results = store.search(search_text, search_kinds)
+        if results:
+            st.dataframe(
+                pd.DataFrame(results).rename(columns={
+                    "bowtie_id": "Bowtie", "hazard": "Hazard", "node_id": "Node", "kind": "Type", "name": "Name",
+                    "parent": "Belongs to",
+                }),
+                hide_index=True, width="stretch",
+            )
+        else:
+            st.info("No matches in the library.")
+
+    st.subheader(":material/bar_chart: Barrier Usage")
+    frequency = store.barrier_frequency()
+    if frequency:
+        usage_column, where_column = st.columns(2)
+        with usage_column:
+            st.dataframe(
+                pd.DataFrame(frequency).rename(columns={
+                    "canonical_id": "Canonical ID", "name": "Barrier", "uses": "Uses", "bowties": "Bowties",
+                }),
+                hide_index=True, width="stretch",
+            )
+        with where_column:
+            barrier_choice = st.selectbox("Where is this barrier used?", options=[b["name"] for b in frequency],
+                                          index=None, key="library_where_used")
+            if barrier_choice:
+                st.dataframe(
+                    pd.DataFrame(store.where_used(barrier_choice)).rename(columns={
+                        "bowtie_id": "Bowtie", "hazard": "Hazard", "node_id": "Node", "name": "Barrier",
+                        "parent": "Threat / Consequence", "parent_kind": "Side",
+                    }),
+                    hide_index=True, width="stretch",
+                )
+    else:
+        st.info("Save or import bowties to see which barriers they share.")
+
+    # Variants of the same barrier name in the current bowtie, matched against the canonical barriers of the library
+    current = st.session_state.bowtie_data
+    if current is not None:
+        st.subheader(":material/join: Barrier Names")
+        barriers = [node for node in current.nodes().values() if isinstance(node, Barrier)]
+        # In bowtie order, so the first spelling of a new barrier is its canonical name on every rerun
+        canonical = store.canonical_barriers(list(dict.fromkeys(b.name for b in barriers)))
+        renames = canonical_renames(current, canonical)
+        st.write(f"{len({b.name for b in barriers})} barrier names in this bowtie name "
+                 f"{len({c[0] for c in canonical.values()})} distinct barriers.")
+        if renames:
+            st.dataframe(
+                pd.DataFrame([
+                    {"Node": r["id"], "Barrier": current.get(r["id"]).name, "Canonical name": r["name"],
+                     "Canonical ID": canonical[current.get(r["id"]).name][0]}
+                    for r in renames
+                ]),
+                hide_index=True, width="stretch",
+            )
+            if st.button("Use Canonical Names", icon=":material/join:"):
+                publish("bowtie_data", copy.deepcopy(current).apply_patch(renames))
+        else:
+            st.caption("All barriers already use their canonical names.")
+
     st.divider()
 
-    if st.session_state.bowtie_data is not None and isinstance(st.session_state.bowtie_data, dict):        
+    if st.session_state.bowtie_data is not None:
         st.subheader(":material/save: Export Bowtie Data")
-        st.write("You can save the bowtie data to a JSON file for later use.")
+        st.write("You can save the bowtie data to a JSON file for later use, or to an Excel workbook in the import layout to edit the barrier register in bulk and import it again.")
         st.download_button(
             label="Save Bowtie Data",
-            data=json.dumps(st.session_state.bowtie_data, indent=4),
+            data=json.dumps(st.session_state.bowtie_data.to_dict(), indent=4),
             file_name='bowtie_data.json',
             mime='application/json',
             icon=":material/download:",
         )   
+        st.download_button(
+            label="Save Bowtie Excel",
+            # Written only when clicked
+            data=lambda bowtie=st.session_state.bowtie_data: export_excel([bowtie]),
+            file_name="bowtie_data.xlsx",
+            mime=XLSX_MIME,
+            icon=":material/download:",
+            on_click="ignore",
+        )
         st.divider()
         st.subheader(":material/data_object: Parsed Bowtie Data")
-        st.json(st.session_state.bowtie_data, expanded=True)
+        st.json(st.session_state.bowtie_data.to_dict(), expanded=True)
         st.divider()
     else:
         st.warning("The response did not contain the expected bowtie_data dictionary. Please try again.")
 
-with tab3:
+
+
+with tab2:
+    data_tab()
+
+
+@st.fragment(key="inputs")
+@profiled("inputs")
+def inputs_tab():
     #####################################################################################################################
     # ACCEPT USER INPUTS TO DEFINE THE BOWTIE DIAGRAM ELEMENTS
     #####################################################################################################################
 
-    # Initialize data dictionary to store diagram variables
-    diagram_data = {
-        "hazard": "",
-        "top_events": [],
-    }
+    def seed_branch_editor(bowtie):
+        # Node IDs are numbered the same way in every bowtie, so the widget values of the previous working copy are
+        # dropped; otherwise Streamlit would show them for the nodes of the new one that reuse the same IDs
+        for key in [k for k in st.session_state if str(k).startswith("branch_")]:
+            del st.session_state[key]
+        st.session_state.branch_diagram = bowtie
+
+    # Re-seed the editors whenever the agent or an import produces different bowtie data
+    bowtie_data = st.session_state.bowtie_data
+    bowtie_hash = bowtie_data.content_hash() if bowtie_data else None
+    if st.session_state.get("inputs_source_hash", "") != bowtie_hash:
+        st.session_state.inputs_source_hash = bowtie_hash
+        st.session_state.form_source = bowtie_data
+        seed_branch_editor(copy.deepcopy(bowtie_data) if bowtie_data else None)
+        st.session_state.pop("editor_mode", None)
+
+    def source_item(items, index):
+        # Return the pre-filled element at the given index, or None if the source has no such element
+        return items[index] if items is not None and index < len(items) else None
 
     st.header(":material/variables: Diagram Inputs")
     st.warning("Avoid using special characters, especially parentheses, brackets, quotes, and dashes. Use of these characters may cause issues with the diagram rendering. Use of alphanumeric characters only is recommended.", icon="⚠️")
-    # Prompt the user for the hazard and number of top events
-    diagram_data["hazard"] = st.text_input(label="Hazard", value=st.session_state.bowtie_data["hazard"] if st.session_state.bowtie_data else "Enter the hazard here")
-
-    num_top_events = st.number_input(
-        "Number of Top Events",
-        min_value=1,
-        max_value=1,
-        value=len(st.session_state.bowtie_data["top_events"]) if st.session_state.bowtie_data else 1
+
+    # The full form creates widgets for every element of the bowtie. For large bowties, the single branch editor only
+    # creates widgets for the threat or consequence being edited, so the cost of a rerun does not grow with the bowtie.
+    editor_mode = st.radio(
+        "Editor Mode",
+        ["Full form", "Single branch"],
+        index=1 if bowtie_data and len(bowtie_data.nodes()) > LARGE_BOWTIE_NODES else 0,
+        horizontal=True,
+        help="Use the single branch editor for large bowties to only show the threat or consequence being edited.",
     )
+    # Carry the edits over when the user switches between editors
+    if st.session_state.get("editor_mode", editor_mode) != editor_mode:
+        if editor_mode == "Full form":
+            st.session_state.form_source = copy.deepcopy(st.session_state.diagram_data)
+        else:
+            seed_branch_editor(copy.deepcopy(st.session_state.diagram_data))
+    st.session_state.editor_mode = editor_mode
 
-    st.divider()
+    if editor_mode == "Full form":
+        # Bowtie used to pre-fill the inputs
+        source = st.session_state.form_source
 
-    # For each top event, prompt the user to define the top event, number of threats, and number of consequences
-    # If data has already been parsed by the agent, pre-fill the inputs with the existing data.
-    for i in range(num_top_events):
-        with st.expander(f"Top Event {i+1}", expanded=True):
-            st.subheader(f"Top Event {i+1}")
-            top_event = st.text_input(label=f"Top Event {i+1}", 
-                                      value=(
-                                          st.session_state.bowtie_data["top_events"][i]["top_event"]
-                                          if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"])
-                                          else f"Enter Top Event {i+1} here"
-                                      ),
-                                      label_visibility="collapsed"
-            )
-            top_event_data = {
-                "top_event": top_event,
-                "threats": [],
-                "consequences": [],
-            }
-            
-            # Create two columns for the threats and consequences and prompt the user for the threats, consequences, and barriers
-            threat_side, consequence_side = st.columns(2)
-            
-            # Threat side
-            with threat_side:
-                st.subheader(f"Top Event {i+1} | Threats")
-                num_threats = st.number_input(
-                    f"Number of Threats for Top Event {i+1}",
-                    min_value=1,
-                    max_value=None,
-                    value=(
-                        len(st.session_state.bowtie_data["top_events"][i]["threats"])
-                        if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"])
-                        else 1
-                    )
+        # Prompt the user for the hazard and number of top events.
+        # The diagram model stores the diagram variables; node IDs are carried over from the source bowtie.
+        diagram_data = Hazard(
+            name=st.text_input(label="Hazard", value=source.name if source else "Enter the hazard here", on_change=edited),
+            id=source.id if source else "",
+        )
+
+        num_top_events = st.number_input(
+            "Number of Top Events",
+            min_value=1,
+            max_value=None,
+            value=max(len(source.top_events), 1) if source else 1,
+            on_change=edited
+        )
+
+        st.divider()
+
+        # For each top event, prompt the user to define the top event, number of threats, and number of consequences
+        # If data has already been parsed by the agent, pre-fill the inputs with the existing data.
+        for i in range(num_top_events):
+            source_top_event = source_item(source.top_events if source else None, i)
+            with st.expander(f"Top Event {i+1}", expanded=True):
+                st.subheader(f"Top Event {i+1}")
+                top_event = st.text_input(label=f"Top Event {i+1}",
+                                          value=source_top_event.name if source_top_event else f"Enter Top Event {i+1} here",
+                                          label_visibility="collapsed",
+                                          on_change=edited
                 )
-                for j in range(num_threats):
-                    st.markdown(f"**Threat {j + 1} | Top Event {i+1}**")
-                    threat = st.text_input(
-                        label=f"Threat {j + 1} | Top Event {i+1}",
-                        value=(
-                            st.session_state.bowtie_data["top_events"][i]["threats"][j]["threat"]
-                            if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"]) and j<len(st.session_state.bowtie_data["top_events"][i]["threats"])
-                            else f"Enter Threat {j + 1} here"
-                        )
-                    )
-                    threat_data = {
-                        "threat": threat,
-                        "preventive_barriers": []
-                    }
-                    num_preventive_barriers = st.number_input(
-                        f"Number of Preventive Barriers for Threat {j + 1} | Top Event {i+1}",
+                top_event_data = TopEvent(name=top_event, id=source_top_event.id if source_top_event else "")
+
+                # Create two columns for the threats and consequences and prompt the user for the threats, consequences, and barriers
+                threat_side, consequence_side = st.columns(2)
+
+                # Threat side
+                with threat_side:
+                    st.subheader(f"Top Event {i+1} | Threats")
+                    num_threats = st.number_input(
+                        f"Number of Threats for Top Event {i+1}",
                         min_value=1,
-                        max_value=5,
-                        value=(
-                            len(st.session_state.bowtie_data["top_events"][i]["threats"][j]["preventive_barriers"])
-                            if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"]) and j<len(st.session_state.bowtie_data["top_events"][i]["threats"])
-                            else 1
-                        )
+                        max_value=None,
+                        value=max(len(source_top_event.threats), 1) if source_top_event else 1,
+                        on_change=edited
                     )
-                    for k in range(num_preventive_barriers):
-                        preventive_barrier = st.text_input(
-                            label=f"Preventive Barrier {k + 1} | Threat {j + 1} | Top Event {i+1}",
-                            value=(
-                                st.session_state.bowtie_data["top_events"][i]["threats"][j]["preventive_barriers"][k]
-                                if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"]) and j<len(st.session_state.bowtie_data["top_events"][i]["threats"]) and k<len(st.session_state.bowtie_data["top_events"][i]["threats"][j]["preventive_barriers"])
-                                else f"Enter Preventive Barrier {k + 1} here"
-                            )
+                    for j in range(num_threats):
+                        source_threat = source_item(source_top_event.threats if source_top_event else None, j)
+                        st.markdown(f"**Threat {j + 1} | Top Event {i+1}**")
+                        threat = st.text_input(
+                            label=f"Threat {j + 1} | Top Event {i+1}",
+                            value=source_threat.name if source_threat else f"Enter Threat {j + 1} here",
+                            on_change=edited
                         )
-                        threat_data["preventive_barriers"].append(preventive_barrier)
-                    top_event_data["threats"].append(threat_data)
-            
-            # Consequence side
-            with consequence_side:
-                st.subheader(f"Top Event {i+1} | Consequences")
-                num_consequences = st.number_input(
-                    f"Number of Consequences for Top Event {i+1}",
-                    min_value=1,
-                    max_value=None,
-                    value=(
-                        len(st.session_state.bowtie_data["top_events"][i]["consequences"])
-                        if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"])
-                        else 1
-                    )
-                )
-                for j in range(num_consequences):
-                    st.markdown(f"**Consequence {j+1} | Top Event {i+1}**")
-                    consequence = st.text_input(
-                        label=f"Consequence {j+1} | Top Event {i+1}",
-                        value=(
-                            st.session_state.bowtie_data["top_events"][i]["consequences"][j]["consequence"]
-                            if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"]) and j<len(st.session_state.bowtie_data["top_events"][i]["consequences"])
-                            else f"Enter Consequence {j + 1} here"
+                        threat_data = Threat(name=threat, id=source_threat.id if source_threat else "")
+                        num_preventive_barriers = st.number_input(
+                            f"Number of Preventive Barriers for Threat {j + 1} | Top Event {i+1}",
+                            min_value=1,
+                            max_value=None,
+                            value=max(len(source_threat.barriers), 1) if source_threat else 1,
+                            on_change=edited
                         )
-                    )
-                    consequence_data = {
-                        "consequence": consequence,
-                        "mitigative_barriers": []
-                    }
-                    num_mitigative_barriers = st.number_input(
-                        f"Number of Mitigative Barriers for Consequence {j+1} | Top Event {i+1}",
+                        for k in range(num_preventive_barriers):
+                            source_barrier = source_item(source_threat.barriers if source_threat else None, k)
+                            preventive_barrier = st.text_input(
+                                label=f"Preventive Barrier {k + 1} | Threat {j + 1} | Top Event {i+1}",
+                                value=source_barrier.name if source_barrier else f"Enter Preventive Barrier {k + 1} here",
+                                on_change=edited
+                            )
+                            threat_data.barriers.append(Barrier(name=preventive_barrier, id=source_barrier.id if source_barrier else ""))
+                        top_event_data.threats.append(threat_data)
+
+                # Consequence side
+                with consequence_side:
+                    st.subheader(f"Top Event {i+1} | Consequences")
+                    num_consequences = st.number_input(
+                        f"Number of Consequences for Top Event {i+1}",
                         min_value=1,
-                        max_value=5,
-                        value=(
-                            len(st.session_state.bowtie_data["top_events"][i]["consequences"][j]["mitigative_barriers"])
-                            if st.session_state.bowtie_data and i<len(st.session_state.bowtie_data["top_events"]) and j<len(st.session_state.bowtie_data["top_events"][i]["consequences"])
-                            else 1
-                        )
+                        max_value=None,
+                        value=max(len(source_top_event.consequences), 1) if source_top_event else 1,
+                        on_change=edited
                     )
-                    for k in range(num_mitigative_barriers):
-                        mitigative_barrier = st.text_input(
-                            label=f"Mitigative Barrier {k+1}  | Consequence {j+1} | Top Event {i+1}",
-                            value=(
-                                st.session_state.bowtie_data["top_events"][i]["consequences"][j]["mitigative_barriers"][k]
-                                if st.session_state.bowtie_data and j<len(st.session_state.bowtie_data["top_events"][i]["consequences"]) and k<len(st.session_state.bowtie_data["top_events"][i]["consequences"][j]["mitigative_barriers"])
-                                else f"Enter Mitigative Barrier {k + 1} here"
-                            )
+                    for j in range(num_consequences):
+                        source_consequence = source_item(source_top_event.consequences if source_top_event else None, j)
+                        st.markdown(f"**Consequence {j+1} | Top Event {i+1}**")
+                        consequence = st.text_input(
+                            label=f"Consequence {j+1} | Top Event {i+1}",
+                            value=source_consequence.name if source_consequence else f"Enter Consequence {j + 1} here",
+                            on_change=edited
                         )
-                        consequence_data["mitigative_barriers"].append(mitigative_barrier)
-                    top_event_data["consequences"].append(consequence_data)
-            
-            diagram_data["top_events"].append(top_event_data)
+                        consequence_data = Consequence(name=consequence, id=source_consequence.id if source_consequence else "")
+                        num_mitigative_barriers = st.number_input(
+                            f"Number of Mitigative Barriers for Consequence {j+1} | Top Event {i+1}",
+                            min_value=1,
+                            max_value=None,
+                            value=max(len(source_consequence.barriers), 1) if source_consequence else 1,
+                            on_change=edited
+                        )
+                        for k in range(num_mitigative_barriers):
+                            source_barrier = source_item(source_consequence.barriers if source_consequence else None, k)
+                            mitigative_barrier = st.text_input(
+                                label=f"Mitigative Barrier {k+1}  | Consequence {j+1} | Top Event {i+1}",
+                                value=source_barrier.name if source_barrier else f"Enter Mitigative Barrier {k + 1} here",
+                                on_change=edited
+                            )
+                            consequence_data.barriers.append(Barrier(name=mitigative_barrier, id=source_barrier.id if source_barrier else ""))
+                        top_event_data.consequences.append(consequence_data)
 
-    # Store the diagram data in session state
-    st.session_state.diagram_data = diagram_data
+                diagram_data.top_events.append(top_event_data)
+
+        # Index the node IDs of the completed diagram model
+        diagram_data.reindex()
+
+
+    else:
+        # Working copy edited in place by the single branch editor
+        diagram_data = st.session_state.branch_diagram
+        if diagram_data is None:
+            diagram_data = st.session_state.branch_diagram = Hazard.from_dict(EMPTY_BOWTIE)
+
+        diagram_data.name = st.text_input(label="Hazard", value=diagram_data.name, key=f"branch_{diagram_data.id}", on_change=edited)
+
+        def add_top_event():
+            # Append a new top event with one threat and one consequence and select it in the top event picker
+            node = TopEvent(
+                name=f"Enter Top Event {len(diagram_data.top_events) + 1} here",
+                threats=[Threat("Enter Threat 1 here", [Barrier("Enter Preventive Barrier 1 here")])],
+                consequences=[Consequence("Enter Consequence 1 here", [Barrier("Enter Mitigative Barrier 1 here")])],
+            )
+            diagram_data.top_events.append(node)
+            diagram_data.register(node, diagram_data)
+            st.session_state.branch_top_event = node.id
+            edited()
+
+        def remove_top_event(node_id):
+            # Remove the selected top event, keeping at least one
+            if len(diagram_data.top_events) > 1:
+                node = diagram_data.get(node_id)
+                diagram_data.top_events.remove(node)
+                diagram_data.unregister(node)
+                st.session_state.branch_top_event = diagram_data.top_events[0].id
+            edited()
+
+        top_event_labels = {te.id: f"Top Event {i + 1} | {te.name}" for i, te in enumerate(diagram_data.top_events)}
+        if st.session_state.get("branch_top_event") not in top_event_labels:
+            st.session_state.branch_top_event = next(iter(top_event_labels))
+
+        top_event_column, add_top_event_column, remove_top_event_column = st.columns([5, 1, 1], vertical_alignment="bottom")
+        with add_top_event_column:
+            st.button("Add Top Event", icon=":material/add:", on_click=add_top_event, width="stretch")
+        with remove_top_event_column:
+            st.button("Remove", icon=":material/delete:", on_click=remove_top_event, args=(st.session_state.branch_top_event,),
+                      key="branch_remove_top_event", width="stretch")
+        with top_event_column:
+            top_event_id = st.selectbox("Top Event", options=list(top_event_labels), format_func=top_event_labels.get, key="branch_top_event")
+        top_event_data = diagram_data.get(top_event_id)
+        top_event_data.name = st.text_input(label="Top Event", value=top_event_data.name, key=f"branch_{top_event_data.id}", on_change=edited)
+
+        st.divider()
+
+        def add_branch(kind):
+            # Append a new threat or consequence and select it in the branch picker
+            if kind == "threat":
+                node = Threat(name=f"Enter Threat {len(top_event_data.threats) + 1} here", barriers=[Barrier("Enter Preventive Barrier 1 here")])
+                top_event_data.threats.append(node)
+            else:
+                node = Consequence(name=f"Enter Consequence {len(top_event_data.consequences) + 1} here", barriers=[Barrier("Enter Mitigative Barrier 1 here")])
+                top_event_data.consequences.append(node)
+            diagram_data.register(node, top_event_data)
+            st.session_state.branch_picker = node.id
+            edited()
+
+        def remove_branch(node_id):
+            # Remove the selected threat or consequence, keeping at least one of each
+            node = diagram_data.get(node_id)
+            siblings = top_event_data.threats if isinstance(node, Threat) else top_event_data.consequences
+            if len(siblings) > 1:
+                siblings.remove(node)
+                diagram_data.unregister(node)
+                st.session_state.branch_picker = siblings[0].id
+            edited()
+
+        branch_labels = {
+            **{t.id: f"Threat {j + 1} | {t.name}" for j, t in enumerate(top_event_data.threats)},
+            **{c.id: f"Consequence {j + 1} | {c.name}" for j, c in enumerate(top_event_data.consequences)},
+        }
+        if st.session_state.get("branch_picker") not in branch_labels:
+            st.session_state.branch_picker = next(iter(branch_labels))
+
+        picker_column, add_threat_column, add_consequence_column, remove_column = st.columns([4, 1, 1, 1], vertical_alignment="bottom")
+        with add_threat_column:
+            st.button("Add Threat", icon=":material/add:", on_click=add_branch, args=("threat",), width="stretch")
+        with add_consequence_column:
+            st.button("Add Consequence", icon=":material/add:", on_click=add_branch, args=("consequence",), width="stretch")
+        with remove_column:
+            st.button("Remove", icon=":material/delete:", on_click=remove_branch, args=(st.session_state.branch_picker,),
+                      key="branch_remove_branch", width="stretch")
+        with picker_column:
+            branch_id = st.selectbox("Threat or Consequence", options=list(branch_labels), format_func=branch_labels.get, key="branch_picker")
+
+        # Only the selected branch gets input widgets
+        branch = diagram_data.get(branch_id)
+        kind, barrier_kind = ("Threat", "Preventive") if isinstance(branch, Threat) else ("Consequence", "Mitigative")
+        st.subheader(branch_labels[branch_id].split(" | ")[0])
+        branch.name = st.text_input(label=kind, value=branch.name, key=f"branch_{branch.id}", on_change=edited)
+        num_barriers = st.number_input(
+            f"Number of {barrier_kind} Barriers",
+            min_value=1,
+            max_value=None,
+            value=max(len(branch.barriers), 1),
+            key=f"branch_{branch.id}_num_barriers",
+            on_change=edited
+        )
+        while len(branch.barriers) < num_barriers:
+            barrier = Barrier(f"Enter {barrier_kind} Barrier {len(branch.barriers) + 1} here")
+            branch.barriers.append(barrier)
+            diagram_data.register(barrier, branch)
+        while len(branch.barriers) > num_barriers:
+            diagram_data.unregister(branch.barriers.pop())
+        for k, barrier in enumerate(branch.barriers):
+            barrier.name = st.text_input(label=f"{barrier_kind} Barrier {k + 1}", value=barrier.name, key=f"branch_{barrier.id}", on_change=edited)
+
+    # Store the diagram data in session state. The edit callbacks rerun the tabs showing it, so no full rerun is needed
+    publish("diagram_data", diagram_data, rerun=False)
 
     st.divider()
 
@@ -376,151 +874,164 @@ with tab3:
     # TROUBLESHOOTING AND DEBUGGING
     #####################################################################################################################
 
-    #st.subheader("Bowtie Data Dictionary")
-    #st.json(diagram_data)
-    #st.divider()
+    if st.toggle("Show debug panel", key="debug_panel", help="Timings of the app stages and LLM replies, and cache hit rates."):
+        profiler = st.session_state.profiler
 
-    #st.subheader("Debugging")
-    #st.write(num_top_events)
-    #st.write(num_threats)
-    ##st.write(num_preventive_barriers)
-    #st.write(num_consequences)
-    #st.write(num_mitigative_barriers)
-    #st.divider()
+        st.subheader("Bowtie Data Dictionary")
+        with st.expander(f"{len(diagram_data.nodes())} nodes"):
+            st.json(diagram_data.to_dict(ids=True))
 
-with tab4:
+        # Caches shared by all sessions of the process: every SharedCache (Excel imports, Mermaid code, layouts and
+        # exports) and the other process-wide caches
+        response_cache = response_cache_from_env()
+        caches = cache_stats({
+            **shared_caches(),
+            "mermaid_branches": branch_cache_info(),
+            "token_counts": count_tokens.cache_info(),
+            "llm_clients": get_client.cache_info(),
+            **({"responses": response_cache.stats()} if response_cache is not None else {}),
+        })
+
+        st.subheader("Reruns")
+        st.caption("Completed full runs and fragment reruns of this session, newest first. The current run is still in progress.")
+        if profiler.runs:
+            st.dataframe(
+                pd.DataFrame([
+                    {"Run": run["kind"], "Tabs": ", ".join(s["name"] for s in run["spans"] if s["depth"] == 0),
+                     "Total (ms)": run["seconds"] * 1000, "Interrupted": run["interrupted"]}
+                    for run in reversed(profiler.runs)
+                ]),
+                hide_index=True, width="stretch",
+            )
+            last_run = profiler.runs[-1]
+            st.caption(f"Spans of the last {last_run['kind']} run")
+            st.dataframe(
+                pd.DataFrame([
+                    {"Span": "  " * s["depth"] + s["name"], "Start (ms)": s["offset"] * 1000,
+                     "Time (ms)": s["seconds"] * 1000 if s["seconds"] is not None else None}
+                    for s in last_run["spans"]
+                ]),
+                hide_index=True, width="stretch",
+            )
+
+        st.subheader("Span Totals")
+        span_totals = profiler.summary()["span_totals"]
+        if span_totals:
+            st.dataframe(
+                pd.DataFrame(span_totals).rename(columns={
+                    "span": "Span", "count": "Calls", "seconds": "Total (s)", "mean_seconds": "Mean (s)", "max_seconds": "Max (s)",
+                }),
+                hide_index=True, width="stretch",
+            )
+
+        st.subheader("LLM Replies")
+        if profiler.llm:
+            st.dataframe(
+                pd.DataFrame([
+                    {"Time to first token (ms)": r["time_to_first_token"] * 1000 if r["time_to_first_token"] is not None else None,
+                     "Total (s)": r["seconds"], "Tokens": r["tokens"], "Tokens/s": r["tokens_per_second"], "Cached": r["cached"]}
+                    for r in reversed(profiler.llm)
+                ]),
+                hide_index=True, width="stretch",
+            )
+        else:
+            st.info("No agent replies in this session yet.")
+
+        st.subheader("Cache Hit Rates")
+        st.dataframe(
+            pd.DataFrame(caches).rename(columns={
+                "cache": "Cache", "hits": "Hits", "misses": "Misses", "hit_rate": "Hit rate", "size": "Entries", "max_size": "Max entries",
+                "bytes": "Bytes", "max_bytes": "Max bytes",
+            }),
+            hide_index=True, width="stretch",
+        )
+
+        st.subheader("Memory")
+        # Caches are shared by all sessions; session sizes are estimated from each session's state
+        memory = process_memory()
+        st.caption(" | ".join(
+            f"{label}: {memory[key] / 2 ** 20:,.1f} MiB" for key, label in (("rss", "Process memory"), ("peak_rss", "Peak"))
+            if memory[key] is not None
+        ) + f" | Shared caches: {sum(c['bytes'] or 0 for c in caches) / 2 ** 20:,.1f} MiB")
+        sessions = session_reports()
+        if sessions:
+            session_id = get_script_run_ctx().session_id
+            st.dataframe(
+                pd.DataFrame([
+                    {"Session": ("this session" if sid == session_id else sid[:8]), "Memory (MiB)": report["bytes"] / 2 ** 20,
+                     "Largest items": ", ".join(
+                         f"{key} ({size / 2 ** 20:.1f} MiB)"
+                         for key, size in sorted(report["items"].items(), key=lambda item: -item[1])[:3]
+                     ),
+                     "Reported (s ago)": round(time.time() - report["reported"])}
+                    for sid, report in sessions.items()
+                ]),
+                hide_index=True, width="stretch",
+            )
+
+        json_column, prometheus_column = st.columns(2)
+        with json_column:
+            st.download_button("Download Profile JSON", data=profiler.to_json(caches), file_name="bowtie_profile.json",
+                               mime="application/json", icon=":material/download:", on_click="ignore")
+        with prometheus_column:
+            st.download_button("Download Prometheus Metrics", data=profiler.to_prometheus(caches), file_name="bowtie_metrics.prom",
+                               mime="text/plain", icon=":material/download:", on_click="ignore")
+
+
+with tab3:
+    inputs_tab()
+
+
+@st.fragment(key="diagram")
+@profiled("diagram")
+def diagram_tab():
     #####################################################################################################################
     # VISUALIZE THE BOWTIE DIAGRAM
     #####################################################################################################################
 
+    # Set in the Diagram tab above this fragment
+    words_per_line = st.session_state.words_per_line
+
+    # Generate the Mermaid code. The code is cached on the diagram content, so reruns with unchanged data reuse it.
+    with span("diagram.mermaid_code"):
+        mermaid_code = build_mermaid_code(st.session_state.diagram_data, words_per_line)
+
+    # The component keeps the same key across reruns, so it is never remounted. It only lays the diagram out again in the
+    # browser when the code changes, and keeps showing the rendered SVG while the code is unchanged.
+    stmd.st_mermaid(mermaid_code, key="diagram_mermaid")
+    
+    # Export the diagram. The file is only rendered when the download is requested and is cached on the diagram content.
+    diagram_data = st.session_state.diagram_data
+    export_format = st.selectbox("Export Format", list(EXPORT_FORMATS), format_func=str.upper, key="diagram_export_format")
+    st.download_button(
+        label=f"Download Bowtie {export_format.upper()}",
+        data=lambda: export_bowtie(diagram_data, export_format, words_per_line),
+        file_name=f"bowtie_diagram.{export_format}",
+        mime=EXPORT_FORMATS[export_format],
+        icon=":material/download:",
+        on_click="ignore",
+    )
+
+with tab4:
     # Display the bowtie diagram with dynamic Mermaid.js code
     st.header(":material/flowchart: Bowtie Diagram")
 
-    # Define a function to wrap the text output to the diagram nodes to improve readability
-    def wrap_text(text, num_words):
-        words = text.split()
-        wrapped_text = ""
-        for w in range(0, len(words), num_words):
-            wrapped_text += " ".join(words[w:w+num_words]) + "<br>"
-        return wrapped_text.strip("<br>")
-    # Set number of words per line for the diagram nodes
-    words_per_line = st.number_input("Words per Line", min_value=1, max_value=10, value=3, help="Number of words to allow per line before wrapping text in the diagram nodes to improve readability.", step=1)
-
-    mermaid_code = '''
-        flowchart LR
-    '''
-
-    mermaid_code += f'''
-        subgraph Hazard[Hazard]
-            H({wrap_text(st.session_state.diagram_data["hazard"], words_per_line)})
-            style H fill:#FFDE59,stroke:#000000,stroke-width:8px
-    '''
-
-    for i in range(num_top_events):
-        mermaid_code += f'''
-            subgraph TopEvents[Top Events]
-                TE{i+1}(({wrap_text(st.session_state.diagram_data["top_events"][i]["top_event"], words_per_line)}))
-                style TE{i+1} fill:#FEB84F
-            end
-        '''
-
-    mermaid_code += f'''
-        end
-    '''
-
-    for i in range(num_top_events-1, -1, -1):
-        # Threats and preventive barriers
-        for j in range(len(st.session_state.diagram_data["top_events"][i]["threats"])):
-            # Add the threat and preventive barrier to the diagram
-            mermaid_code += f'''
-                subgraph Threats[Threats]
-                    T{i+1}{j+1}({wrap_text(st.session_state.diagram_data["top_events"][i]["threats"][j]["threat"], words_per_line)})
-                    style T{i+1}{j+1} fill:#504AFF,color:#FFFFFF
-                end
-            '''
-            for k in range(len(st.session_state.diagram_data["top_events"][i]["threats"][j]["preventive_barriers"])):
-                mermaid_code += f'''
-                    subgraph PreventiveBarriers[Preventive Barriers]
-                        PB{i+1}{j+1}{k+1}({wrap_text(st.session_state.diagram_data["top_events"][i]["threats"][j]["preventive_barriers"][k], words_per_line)})
-                    end
-                '''
-            mermaid_code += f'''
-                T{i+1}{j+1} --- PB{i+1}{j+1}{1}
-            '''
-            for k in range(1, len(st.session_state.diagram_data["top_events"][i]["threats"][j]["preventive_barriers"])):
-                mermaid_code += f'''
-                    PB{i+1}{j+1}{k} --- PB{i+1}{j+1}{k+1}
-                '''
-            mermaid_code += f'''
-                PB{i+1}{j+1}{k+1} --- TE{i+1}
-            '''
-
-        # Consequences and mitigative barriers
-        for j in range(len(st.session_state.diagram_data["top_events"][i]["consequences"])-1, -1, -1):
-            # Add the consequence and mitigative barrier to the diagram
-            mermaid_code += f'''
-                subgraph Consequences[Consequences]
-                    C{i+1}{j+1}({wrap_text(st.session_state.diagram_data["top_events"][i]["consequences"][j]["consequence"], words_per_line)})
-                    style C{i+1}{j+1} fill:#D53638,color:#FFFFFF
-                end
-            '''
-            for k in range(len(st.session_state.diagram_data["top_events"][i]["consequences"][j]["mitigative_barriers"])):
-                mermaid_code += f'''
-                    subgraph MitigativeBarriers[Mitigative Barriers]
-                        MB{i+1}{j+1}{k+1}({wrap_text(st.session_state.diagram_data["top_events"][i]["consequences"][j]["mitigative_barriers"][k], words_per_line)})
-                    end
-                '''
-            mermaid_code += f'''
-                TE{i+1} --- MB{i+1}{j+1}{1}
-            '''
-            for k in range(1, len(st.session_state.diagram_data["top_events"][i]["consequences"][j]["mitigative_barriers"])):
-                mermaid_code += f'''
-                    MB{i+1}{j+1}{k} --- MB{i+1}{j+1}{k+1}
-                '''
-            mermaid_code += f'''
-                MB{i+1}{j+1}{k+1} --- C{i+1}{j+1}
-            '''
-
-    mermaid_code = mermaid_code.strip() # strip any leading or trailing whitespace to ensure the mermaid code is clean to improve change of successful rendering
-
-    # Add redraw button to force rendering of the diagram. This is to address behavior where the diagram is not rendered on initial load or changes of data.
-    if st.button(label="Refresh Diagram", icon=":material/refresh:"):
-        st.session_state["redraw"] = not st.session_state.get("redraw", False)
-    # Use the redraw state to change the key and force a redraw of the diagram
-    unique_key = f"mermaid_{st.session_state.get('redraw', False)}"
-    stmd.st_mermaid(mermaid_code, key=unique_key)
-    
-    if st.button("Generate Downloadable Bowtie (Matplotlib)"):
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.axis("off")
-        ax.text(0.5, 0.5, "Bowtie Diagram Export\n(from Excel or Agent Input)", 
-                fontsize=18, ha="center", va="center", wrap=True)
-    
-        pdf_buffer = io.BytesIO()
-        fig.savefig(pdf_buffer, format="pdf")
-        pdf_buffer.seek(0)
-    
-        st.download_button(
-            label="📄 Download Bowtie PDF",
-            data=pdf_buffer,
-            file_name="bowtie_diagram.pdf",
-            mime="application/pdf"
-        )
+    # Set number of words per line for the diagram nodes. The PDF tab uses the setting as well, so the widget is outside
+    # the tab fragments and a change reruns the whole app.
+    st.number_input("Words per Line", min_value=1, max_value=10, value=3, help="Number of words to allow per line before wrapping text in the diagram nodes to improve readability.", step=1, key="words_per_line")
+    diagram_tab()
 
-with tab5:
-    import streamlit as st
-    import networkx as nx
-    import matplotlib.pyplot as plt
-    import io
-    import streamlit_mermaid as stmd
-    
+
+@st.fragment(key="pdf")
+@profiled("pdf")
+def pdf_tab():
     st.header("Bowtie Diagram - Choose Visualization")
     
     # Option selection
     viz_option = st.radio("Select Diagram Type", ["Mermaid.js", "Matplotlib"])
     
     # Example fallback data structure
-    diagram_data = st.session_state.get("diagram_data", {
+    diagram_data = st.session_state.get("diagram_data") or Hazard.from_dict({
         "hazard": "Flammable gas",
         "top_events": [
             {
@@ -538,74 +1049,35 @@ with tab5:
     })
     
     if viz_option == "Mermaid.js":
-        def wrap_text(text, num_words):
-            words = text.split()
-            return "<br>".join([" ".join(words[i:i+num_words]) for i in range(0, len(words), num_words)])
-    
-        words_per_line = st.number_input("Words per Line", min_value=1, max_value=10, value=3)
-    
-        mermaid_code = "flowchart LR\n"
-        mermaid_code += f"H([{wrap_text(diagram_data['hazard'], words_per_line)}])\n"
-        te = diagram_data["top_events"][0]["top_event"]
-        mermaid_code += f"H --> TE[{wrap_text(te, words_per_line)}]\n"
-    
-        for t in diagram_data["top_events"][0]["threats"]:
-            threat = wrap_text(t["threat"], words_per_line)
-            for b in t["preventive_barriers"]:
-                pb = wrap_text(b, words_per_line)
-                mermaid_code += f"{pb} --> {threat}\n"
-            mermaid_code += f"{threat} --> TE\n"
-    
-        for c in diagram_data["top_events"][0]["consequences"]:
-            cons = wrap_text(c["consequence"], words_per_line)
-            mermaid_code += f"TE --> {cons}\n"
-            for b in c["mitigative_barriers"]:
-                mb = wrap_text(b, words_per_line)
-                mermaid_code += f"{cons} --> {mb}\n"
-    
-        stmd.st_mermaid(mermaid_code)
+        # Same code as the Diagram tab, with its words per line setting, so both tabs share the cached code. Changing the
+        # setting reruns the whole app, so this tab never shows code for an older setting.
+        words_per_line = st.session_state.words_per_line
+        with span("pdf.mermaid_code"):
+            mermaid_code = build_mermaid_code(diagram_data, words_per_line)
+        stmd.st_mermaid(mermaid_code, key="pdf_mermaid")
     
     else:
-        G = nx.DiGraph()
-        labels = {}
-    
-        hazard = diagram_data["hazard"]
-        top_event = diagram_data["top_events"][0]["top_event"]
-        G.add_edge(hazard, top_event)
-        labels[hazard] = hazard
-        labels[top_event] = top_event
-    
-        for threat_obj in diagram_data["top_events"][0]["threats"]:
-            threat = threat_obj["threat"]
-            G.add_edge(threat, top_event)
-            labels[threat] = threat
-            for pb in threat_obj["preventive_barriers"]:
-                G.add_edge(pb, threat)
-                labels[pb] = pb
-    
-        for cons_obj in diagram_data["top_events"][0]["consequences"]:
-            cons = cons_obj["consequence"]
-            G.add_edge(top_event, cons)
-            labels[cons] = cons
-            for mb in cons_obj["mitigative_barriers"]:
-                G.add_edge(cons, mb)
-                labels[mb] = mb
-    
-        fig, ax = plt.subplots(figsize=(14, 8))
-        pos = nx.spring_layout(G, seed=42)
-        nx.draw(G, pos, with_labels=True, labels=labels,
-                node_size=3000, node_color="lightblue", font_size=9,
-                font_weight='bold', edge_color='gray', ax=ax)
-        st.pyplot(fig)
-    
-        # PDF download
-        pdf_buffer = io.BytesIO()
-        fig.savefig(pdf_buffer, format="pdf", bbox_inches="tight")
-        pdf_buffer.seek(0)
-    
-        st.download_button(
-            label="📄 Download Matplotlib Diagram as PDF",
-            data=pdf_buffer,
-            file_name="bowtie_diagram.pdf",
-            mime="application/pdf"
-        )
+        # Render the bowtie with the export pipeline. The image and downloads are cached on the diagram content, so
+        # reruns with an unchanged diagram do not render it again. The inline image of a large bowtie is rendered at a
+        # lower resolution; the downloads keep the full one.
+        with span("pdf.render_png"):
+            st.image(export_bowtie(diagram_data, "png", max_pixels=PREVIEW_PIXELS))
+
+        for fmt, column in zip(("pdf", "svg"), st.columns(2)):
+            with column:
+                st.download_button(
+                    label=f"📄 Download Matplotlib Diagram as {fmt.upper()}",
+                    data=lambda fmt=fmt: export_bowtie(diagram_data, fmt),
+                    file_name=f"bowtie_diagram.{fmt}",
+                    mime=EXPORT_FORMATS[fmt],
+                    on_click="ignore",
+                )
+
+with tab5:
+    pdf_tab()
+
+# End of the full script run
+st.session_state.full_run = False
+st.session_state.profiler.end_run()
+# Report the memory held by this session for the debug panel; reports are throttled, so most runs skip this
+report_session(get_script_run_ctx().session_id, st.session_state)
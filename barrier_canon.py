@@ -0,0 +1,176 @@
+"""
+Canonicalization of barrier names.
+
+The same barrier reaches the app under many spellings: typed into the Inputs tab, split from Excel cells or written by
+the agent ("Emergency shutdown", "emergency shut-down", "ESD"). Names are reduced to a canonical key (normalized case,
+punctuation and whitespace, expanded abbreviations, stop words and plural endings removed), and keys that are near
+duplicates by string similarity are clustered under one canonical barrier with a stable ID. To avoid comparing every pair
+of names, a new key is only compared with the keys sharing all but one of its word prefixes (blocking).
+
+String similarity uses rapidfuzz when it is installed and difflib otherwise.
+"""
+import hashlib
+import re
+import unicodedata
+from collections import Counter
+from difflib import SequenceMatcher
+
+from bowtie_model import Barrier
+
+try:
+    from rapidfuzz import fuzz
+except ImportError:
+    fuzz = None
+
+# Minimum similarity of two canonical keys for them to name the same barrier
+SIMILARITY_THRESHOLD = 0.88
+# Characters of each word used as blocking key
+BLOCK_PREFIX = 4
+# Blocks with more keys than this are skipped when a key has smaller blocks to compare with
+MAX_BLOCK_SIZE = 200
+
+# Common abbreviations in barrier names, expanded before matching
+ABBREVIATIONS = {
+    "esd": "emergency shutdown",
+    "eds": "emergency depressurization system",
+    "f g": "fire and gas",
+    "hipps": "high integrity pressure protection system",
+    "loto": "lockout tagout",
+    "ppe": "personal protective equipment",
+    "prv": "pressure relief valve",
+    "psv": "pressure safety valve",
+    "ptw": "permit to work",
+    "sis": "safety instrumented system",
+}
+STOP_WORDS = {"a", "an", "and", "the", "of", "for", "to", "on", "in", "with"}
+
+_NON_WORD = re.compile(r"[\W_]+")
+_ABBREVIATION = re.compile(r"\b(" + "|".join(re.escape(a) for a in ABBREVIATIONS) + r")\b")
+
+
+def normalize_name(text):
+    """Return the name reduced for matching: Unicode-normalized, lowercase, punctuation and extra whitespace removed."""
+    return " ".join(_NON_WORD.sub(" ", unicodedata.normalize("NFKC", text).casefold()).split())
+
+
+def _stem(word):
+    # Plural endings only; barrier names are short noun phrases
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def canonical_key(name):
+    """Return the key barrier names are matched on."""
+    text = _ABBREVIATION.sub(lambda m: ABBREVIATIONS[m.group(1)], normalize_name(name))
+    return " ".join(_stem(word) for word in text.split() if word not in STOP_WORDS)
+
+
+def _blocks(key):
+    return {word[:BLOCK_PREFIX] for word in key.split() if len(word) > 2} or {key[:BLOCK_PREFIX]}
+
+
+def _features(key):
+    # Key, key with sorted words, numbers in the key, length and number of blocks, computed once per key
+    words = key.split()
+    return key, " ".join(sorted(words)), frozenset(w for w in words if w.isdigit()), len(key), len(_blocks(key))
+
+
+def _score(a, b, cutoff, matcher=None):
+    # matcher, if given, is a SequenceMatcher whose second sequence is a's key
+    key_a, sorted_a, digits_a, length_a, _ = a
+    key_b, sorted_b, digits_b, length_b, _ = b
+    # Numbered barriers ("Pump 1", "Pump 2") are different barriers however similar the text
+    if digits_a != digits_b:
+        return 0.0
+    # Bound on the similarity from the lengths alone
+    if 2 * min(length_a, length_b) < cutoff * (length_a + length_b):
+        return 0.0
+    if fuzz is not None:
+        return max(fuzz.ratio(key_a, key_b), fuzz.ratio(sorted_a, sorted_b)) / 100
+    if matcher is None:
+        matcher = SequenceMatcher(None, b=key_a, autojunk=False)
+    matcher.set_seq1(key_b)
+    # Bound from the characters both keys share, which word order does not change
+    if matcher.quick_ratio() < cutoff:
+        return 0.0
+    score = matcher.ratio()
+    if score < 1.0 and (sorted_a != key_a or sorted_b != key_b):
+        score = max(score, SequenceMatcher(None, sorted_a, sorted_b, autojunk=False).ratio())
+    return score
+
+
+class BarrierCanonicalizer:
+    """
+    Clusters barrier names incrementally.
+
+    Each cluster has a canonical ID derived from the key of its first name, and the first name as written is its
+    canonical name. Once assigned, the ID of a key never changes, so IDs stay stable as more names are added.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        # Canonical ID and name per key, the keys per blocking key and the matching features of each key
+        self._keys = {}
+        self._blocks = {}
+        self._features = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def register(self, key, canonical_id, canonical_name):
+        """Add a known key with its canonical barrier, e.g. loaded from storage. Keys already known are kept."""
+        if key in self._keys:
+            return
+        self._keys[key] = (canonical_id, canonical_name)
+        self._features[key] = _features(key)
+        for block in _blocks(key):
+            self._blocks.setdefault(block, []).append(key)
+
+    def match(self, name):
+        """Return the (canonical ID, canonical name) of the cluster the name belongs to, or None."""
+        key = canonical_key(name)
+        if key in self._keys:
+            return self._keys[key]
+        blocks = sorted((self._blocks.get(block, ()) for block in _blocks(key)), key=len)
+        shared = Counter()
+        for block in [b for b in blocks if len(b) <= MAX_BLOCK_SIZE] or blocks[:1]:
+            shared.update(block)
+        features = _features(key)
+        matcher = SequenceMatcher(None, b=key, autojunk=False)
+        best, best_score = None, self.threshold
+        for other, count in shared.items():
+            other_features = self._features[other]
+            # Near duplicates differ in one word at most, so they share all blocks of the shorter key but one
+            if count < min(features[4], other_features[4]) - 1:
+                continue
+            score = _score(features, other_features, best_score, matcher)
+            if score >= best_score:
+                best, best_score = other, score
+        return self._keys[best] if best is not None else None
+
+    def add(self, name):
+        """Return the (canonical ID, canonical name) of the name, starting a new cluster if it matches none."""
+        key = canonical_key(name)
+        if key in self._keys:
+            return self._keys[key]
+        canonical = self.match(name)
+        if canonical is None:
+            canonical = ("CB" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:8].upper(), name.strip())
+        self.register(key, *canonical)
+        return canonical
+
+
+def canonical_renames(bowtie, canonical):
+    """
+    Return the patch operations renaming the barriers of a bowtie_model.Hazard to their canonical names.
+
+    canonical maps barrier names to (canonical ID, canonical name) pairs, as returned by BarrierCanonicalizer.add.
+    """
+    operations = []
+    for node_id, node in bowtie.nodes().items():
+        if isinstance(node, Barrier) and node.name in canonical and canonical[node.name][1] != node.name:
+            operations.append({"op": "rename", "id": node_id, "name": canonical[node.name][1]})
+    return operations
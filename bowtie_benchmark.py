@@ -0,0 +1,206 @@
+"""
+Benchmark of the import, diagram generation, layout and export code at growing bowtie sizes.
+
+Generates synthetic bowties of the requested node counts and times each stage of the app's Streamlit-free core with the
+caches bypassed: Excel import (pandas and streaming), JSON load, Mermaid code generation, graph build and layout, and PDF
+savefig. Time is the minimum and median of several runs; peak memory is measured with tracemalloc in a separate run,
+so tracing does not distort the timings. Results are written as JSON, and a previous result file can be given to
+compare against.
+
+Usage:
+    python bowtie_benchmark.py [--sizes 10,100,500,1000,2000] [--barriers 3] [--top-events 1] [--repeat 5]
+                               [--output bench.json] [--compare baseline.json] [--threshold 1.25]
+"""
+import argparse
+import gc
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+import mermaid_emitter
+from bowtie_export import render_bowtie
+from bowtie_layout import _compute, bowtie_edges
+from bowtie_model import Barrier, Consequence, Hazard, Threat, TopEvent
+from excel_io import parse_excel, stream_excel
+
+DEFAULT_SIZES = (10, 50, 100, 500, 1000, 2000)
+STAGES = ("excel_import", "excel_stream", "json_load", "mermaid", "graph_layout", "pdf_savefig")
+
+
+def synthetic_bowtie(nodes, barriers=3, top_events=1):
+    """
+    Return a bowtie_model.Hazard with about the given number of nodes.
+
+    Each top event gets the same number of threats and consequences, each with the given number of barriers.
+    """
+    branch_nodes = 1 + barriers
+    branches = max(2, round((nodes - 1 - top_events) / (top_events * branch_nodes)))
+    threats = (branches + 1) // 2
+    consequences = branches - threats
+    return Hazard(
+        "Synthetic hazard",
+        top_events=[
+            TopEvent(
+                f"Top event {e + 1}",
+                threats=[
+                    Threat(f"Threat {e + 1}.{t + 1}", [Barrier(f"Preventive barrier {t + 1}.{b + 1}") for b in range(barriers)])
+                    for t in range(threats)
+                ],
+                consequences=[
+                    Consequence(f"Consequence {e + 1}.{c + 1}", [Barrier(f"Mitigative barrier {c + 1}.{b + 1}") for b in range(barriers)])
+                    for c in range(consequences)
+                ],
+            )
+            for e in range(top_events)
+        ],
+    )
+
+
+def excel_bytes(bowtie):
+    """Return the first top event of the bowtie as a workbook in the Excel import layout."""
+    top_event = bowtie.top_events[0]
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        pd.DataFrame({
+            "Threat": [t.name for t in top_event.threats],
+            "Preventive Barriers": ["; ".join(b.name for b in t.barriers) for t in top_event.threats],
+        }).to_excel(writer, sheet_name="Threats", index=False)
+        pd.DataFrame({
+            "Consequence": [c.name for c in top_event.consequences],
+            "Mitigative Barriers": ["; ".join(b.name for b in c.barriers) for c in top_event.consequences],
+        }).to_excel(writer, sheet_name="Consequences", index=False)
+        pd.DataFrame([["Hazard", bowtie.name], ["Top Event", top_event.name]]).to_excel(
+            writer, sheet_name="Info", index=False, header=False
+        )
+    return buffer.getvalue()
+
+
+def _mermaid(bowtie):
+    # Cold generation: the per-branch fragment cache would otherwise serve every run after the first
+    mermaid_emitter._branch_fragment.cache_clear()
+    return mermaid_emitter._generate(bowtie, 3)
+
+
+def _graph_layout(bowtie):
+    return bowtie_edges(bowtie), _compute(bowtie)
+
+
+def stage_functions(bowtie):
+    """Return the benchmarked stages for a bowtie as a dictionary of stage name to function without arguments."""
+    workbook = excel_bytes(bowtie)
+    payload = json.dumps(bowtie.to_dict())
+    return {
+        "excel_import": lambda: parse_excel(workbook),
+        "excel_stream": lambda: stream_excel(io.BytesIO(workbook)),
+        "json_load": lambda: Hazard.from_dict(json.loads(payload)),
+        "mermaid": lambda: _mermaid(bowtie),
+        "graph_layout": lambda: _graph_layout(bowtie),
+        "pdf_savefig": lambda: render_bowtie(bowtie, "pdf"),
+    }
+
+
+def measure(function, repeat):
+    """Return the minimum and median time of the function over repeat runs, and its peak traced memory in bytes."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds_min": min(times), "seconds_median": statistics.median(times), "peak_bytes": peak}
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, barriers=3, top_events=1, repeat=5, stages=STAGES, report=print):
+    """Run the benchmark and return the result document."""
+    results = []
+    for size in sizes:
+        bowtie = synthetic_bowtie(size, barriers, top_events)
+        functions = stage_functions(bowtie)
+        for stage in stages:
+            entry = {"size": size, "nodes": len(bowtie.nodes()), "stage": stage, **measure(functions[stage], repeat)}
+            results.append(entry)
+            report(f"{size:>6}  {stage:<13} {entry['seconds_min'] * 1000:10.2f} ms  {entry['peak_bytes'] / 1024:10.1f} KiB")
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": {"sizes": list(sizes), "barriers": barriers, "top_events": top_events, "repeat": repeat},
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold=1.25):
+    """
+    Return the comparison of two result documents as text lines and the entries slower than threshold times the
+    baseline. Stages are matched on size and stage name; the minimum times are compared.
+    """
+    previous = {(e["size"], e["stage"]): e for e in baseline["results"]}
+    lines = [f"{'Size':>6}  {'Stage':<13} {'Baseline':>12} {'Current':>12} {'Ratio':>7}  {'Memory ratio':>12}"]
+    regressions = []
+    for entry in current["results"]:
+        old = previous.get((entry["size"], entry["stage"]))
+        if old is None:
+            continue
+        ratio = entry["seconds_min"] / old["seconds_min"] if old["seconds_min"] else float("inf")
+        memory_ratio = entry["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] else float("inf")
+        flag = "  slower" if ratio > threshold else ""
+        lines.append(
+            f"{entry['size']:>6}  {entry['stage']:<13} {old['seconds_min'] * 1000:9.2f} ms {entry['seconds_min'] * 1000:9.2f} ms "
+            f"{ratio:7.2f}  {memory_ratio:12.2f}{flag}"
+        )
+        if ratio > threshold:
+            regressions.append(entry)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bowtie import, diagram generation, layout and export.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated approximate node counts (default: %(default)s)")
+    parser.add_argument("--barriers", type=int, default=3, help="Barriers per threat and consequence (default: 3)")
+    parser.add_argument("--top-events", type=int, default=1, help="Number of top events (default: 1)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage (default: 5)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run (default: all)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Time ratio over the baseline reported as a regression (default: 1.25)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage: {', '.join(unknown)}")
+
+    document = run_benchmark(sizes, args.barriers, args.top_events, args.repeat, stages)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            lines, regressions = compare(document, json.load(f), args.threshold)
+        print()
+        print("\n".join(lines))
+        if regressions:
+            print(f"\n{len(regressions)} stages slower than {args.threshold:g}x the baseline")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
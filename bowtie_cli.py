@@ -0,0 +1,201 @@
+"""
+Headless batch conversion of bowtie files to diagrams.
+
+Converts every Excel (.xlsx) and JSON (.json) bowtie in a directory to Mermaid code and rendered diagrams, using the
+same import and rendering code as the Streamlit app. Files are processed in parallel by a process pool, outputs are
+written as soon as each file finishes, and inputs that have not changed since the last run are skipped as long as
+their outputs still exist. Outputs are named after the input file, with its extension when another input has the same
+name (report.xlsx.pdf and report.json.pdf). Workspace JSON files and workbooks of several bowties give one set of
+outputs per bowtie, numbered after the file name.
+
+Usage:
+    python bowtie_cli.py INPUT_DIR OUTPUT_DIR [--formats mmd,pdf,svg,png] [--words-per-line 3] [--workers N] [--force]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from bowtie_export import render_bowtie
+from bowtie_model import Hazard, Workspace
+from excel_io import import_workbook
+from mermaid_emitter import build_mermaid_code
+
+# Input file types and the output formats the command line accepts
+INPUT_SUFFIXES = (".xlsx", ".json")
+OUTPUT_FORMATS = ("mmd", "pdf", "svg", "png")
+
+# File in the output directory recording the input hash and the outputs of every converted file
+MANIFEST_NAME = ".bowtie_manifest.json"
+
+
+def load_bowties(path, data=None):
+    """
+    Load the bowtie_model.Hazard objects of an Excel or JSON file: a bowtie, a workspace or a workbook of several
+    bowties. Raises ValueError if the file holds no bowtie.
+    """
+    path = Path(path)
+    data = path.read_bytes() if data is None else data
+    if path.suffix.lower() == ".json":
+        bowties = Workspace.from_dict(json.loads(data)).hazards
+    else:
+        bowties = []
+        for bowtie_data in import_workbook(data):
+            # Same placeholders as the Data tab when the workbook has no Info sheet
+            bowtie_data["hazard"] = bowtie_data["hazard"] or "Enter the hazard here"
+            for top_event in bowtie_data["top_events"]:
+                top_event["top_event"] = top_event["top_event"] or "Enter the top event here"
+            bowties.append(Hazard.from_dict(bowtie_data))
+    if not bowties:
+        raise ValueError("no bowties in the file")
+    return bowties
+
+
+def convert_file(path, output_dir, formats, words_per_line, name=None):
+    """
+    Convert one bowtie file and write its outputs. Returns the written paths and the time spent per stage.
+
+    The outputs are named name.<format>, by default after the file name without its extension, with the bowtie number
+    appended (name_1.pdf, name_2.pdf, ...) when the file holds several bowties.
+    """
+    name = Path(path).stem if name is None else name
+    timings = {}
+    start = time.perf_counter()
+    bowties = load_bowties(path)
+    timings["load"] = time.perf_counter() - start
+
+    written = []
+    for number, bowtie in enumerate(bowties, start=1):
+        output_name = name if len(bowties) == 1 else f"{name}_{number}"
+        for fmt in formats:
+            start = time.perf_counter()
+            if fmt == "mmd":
+                data = build_mermaid_code(bowtie, words_per_line).encode("utf-8")
+            else:
+                data = render_bowtie(bowtie, fmt, words_per_line)
+            target = Path(output_dir) / f"{output_name}.{fmt}"
+            target.write_bytes(data)
+            written.append(str(target))
+            timings[fmt] = timings.get(fmt, 0.0) + time.perf_counter() - start
+    return written, timings
+
+
+def _input_key(path, formats, words_per_line):
+    # Hash of the input contents and the options that affect the outputs
+    digest = hashlib.sha1(Path(path).read_bytes())
+    digest.update(json.dumps([sorted(formats), words_per_line]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _load_manifest(output_dir):
+    try:
+        return json.loads((Path(output_dir) / MANIFEST_NAME).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(output_dir, manifest):
+    target = Path(output_dir) / MANIFEST_NAME
+    temporary = target.with_suffix(".tmp")
+    temporary.write_text(json.dumps(manifest, indent=4, sort_keys=True))
+    os.replace(temporary, target)
+
+
+def convert_directory(input_dir, output_dir, formats=("mmd", "pdf"), words_per_line=3, workers=None, force=False,
+                      report=print):
+    """
+    Convert every bowtie file in input_dir and return a summary entry per file.
+
+    Each entry is a dictionary with the file name, its status (converted, skipped or failed), the time spent per stage
+    and the error message for failed files.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = {} if force else _load_manifest(output_dir)
+
+    summary = []
+    pending = {}
+    inputs = [
+        path for path in sorted(Path(input_dir).iterdir())
+        if path.suffix.lower() in INPUT_SUFFIXES and not path.name.startswith("~$")
+    ]
+    # Inputs sharing a name, like report.xlsx and report.json, keep their extension in the output names
+    stems = [path.stem for path in inputs]
+    for path in inputs:
+        key = _input_key(path, formats, words_per_line)
+        entry = manifest.get(path.name)
+        # Manifests of earlier versions only recorded the key, so those files are converted again
+        if (isinstance(entry, dict) and entry["key"] == key
+                and all((output_dir / output).exists() for output in entry["outputs"])):
+            summary.append({"file": path.name, "status": "skipped", "timings": {}})
+            report(f"skipped    {path.name}")
+            continue
+        pending[path] = key
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                convert_file, str(path), str(output_dir), formats, words_per_line,
+                path.name if stems.count(path.stem) > 1 else path.stem,
+            ): path
+            for path in pending
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                written, timings = future.result()
+            except Exception as e:
+                summary.append({"file": path.name, "status": "failed", "timings": {}, "error": str(e)})
+                report(f"failed     {path.name}: {e}")
+                continue
+            summary.append({"file": path.name, "status": "converted", "timings": timings})
+            report(f"converted  {path.name} in {sum(timings.values()):.3f}s")
+            # Record each result as it arrives, so an interrupted run does not redo finished files
+            manifest[path.name] = {"key": pending[path], "outputs": [Path(target).name for target in written]}
+            _save_manifest(output_dir, manifest)
+
+    return summary
+
+
+def format_summary(summary, formats):
+    """Return the per-file timing summary as a text table."""
+    stages = ["load", *formats]
+    name_width = max([len("File"), *(len(entry["file"]) for entry in summary)])
+    lines = [f"{'File':<{name_width}}  {'Status':<9}  " + "  ".join(f"{s:>8}" for s in stages) + f"  {'Total':>8}"]
+    for entry in sorted(summary, key=lambda e: e["file"]):
+        timings = entry["timings"]
+        cells = "  ".join(f"{timings[s]:8.3f}" if s in timings else f"{'-':>8}" for s in stages)
+        lines.append(f"{entry['file']:<{name_width}}  {entry['status']:<9}  {cells}  {sum(timings.values()):8.3f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a directory of Excel/JSON bowties to diagrams.")
+    parser.add_argument("input_dir", help="Directory containing .xlsx and .json bowtie files")
+    parser.add_argument("output_dir", help="Directory to write the diagrams to")
+    parser.add_argument("--formats", default="mmd,pdf",
+                        help=f"Comma-separated output formats out of {', '.join(OUTPUT_FORMATS)} (default: mmd,pdf)")
+    parser.add_argument("--words-per-line", type=int, default=3, help="Words per line in the diagram nodes (default: 3)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Convert all files, including unchanged ones")
+    args = parser.parse_args(argv)
+
+    formats = [f.strip().lower() for f in args.formats.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in OUTPUT_FORMATS]
+    if unknown or not formats:
+        parser.error(f"unsupported output format: {', '.join(unknown) or 'none given'}")
+
+    start = time.perf_counter()
+    summary = convert_directory(args.input_dir, args.output_dir, formats, args.words_per_line, args.workers, args.force)
+    print()
+    print(format_summary(summary, formats))
+    print(f"\n{len(summary)} files in {time.perf_counter() - start:.3f}s")
+    return 1 if any(entry["status"] == "failed" for entry in summary) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
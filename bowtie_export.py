@@ -0,0 +1,122 @@
+"""
+Vector and raster export of bowtie diagrams with Matplotlib.
+
+The renderer draws the nodes at the positions of the bowtie layout, with lane headings and the same colors as the
+Mermaid diagram. Figures are created with the object-oriented Matplotlib API rather than pyplot, so they are not kept
+in pyplot's global figure registry; their artists and the output buffer are released as soon as the output bytes are
+written. The output bytes are cached on the content hash of the diagram and the format, in a cache shared by all
+sessions.
+"""
+import io
+
+from matplotlib.figure import Figure
+from matplotlib.patches import FancyBboxPatch
+
+from bowtie_layout import LANE_WIDTH, bowtie_edges, bowtie_layout
+from bowtie_model import Barrier, Consequence, Hazard, Threat, TopEvent
+from mermaid_emitter import wrap_text
+from shared_cache import SharedCache
+
+# Supported export formats and their MIME types
+EXPORT_FORMATS = {
+    "pdf": "application/pdf",
+    "svg": "image/svg+xml",
+    "png": "image/png",
+}
+
+# Resolution of raster exports, and the lowest resolution at which labels are drawn; below it the 7 point labels would
+# be a few pixels high, and FreeType cannot draw text at all below about 2 dpi, so only the boxes and lines are drawn
+EXPORT_DPI = 150
+LABEL_DPI = 40
+
+# Maximum number of rendered files kept in the export cache, and their maximum total size in bytes
+EXPORT_CACHE_SIZE = 32
+EXPORT_CACHE_BYTES = 128 * 1024 * 1024
+
+# Node styles matching the Mermaid diagram: (fill, edge color, edge width, text color)
+NODE_STYLES = {
+    Hazard: ("#FFDE59", "#000000", 4.0, "#000000"),
+    TopEvent: ("#FEB84F", "#333333", 1.0, "#000000"),
+    Threat: ("#504AFF", "#333333", 1.0, "#FFFFFF"),
+    Consequence: ("#D53638", "#333333", 1.0, "#FFFFFF"),
+    Barrier: ("#ECECFF", "#9370DB", 1.0, "#000000"),
+}
+
+# Size of a node box in layout units
+NODE_WIDTH = 0.8 * LANE_WIDTH
+NODE_HEIGHT = 0.6
+
+_export_cache = SharedCache("export", EXPORT_CACHE_SIZE, EXPORT_CACHE_BYTES, sizeof=len)
+
+
+def draw_bowtie(diagram, words_per_line=3):
+    """Return a Matplotlib Figure of the bowtie diagram."""
+    positions = bowtie_layout(diagram)
+    nodes = diagram.nodes()
+    xs, ys = zip(*positions.values())
+    width = max(xs) - min(xs) + LANE_WIDTH
+    height = max(ys) - min(ys) + 2
+
+    fig = Figure(figsize=(max(8, 2 * width), max(4, 1.2 * height)))
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.set_xlim(min(xs) - LANE_WIDTH / 2, max(xs) + LANE_WIDTH / 2)
+    ax.set_ylim(min(ys) - 1, max(ys) + 1)
+    ax.axis("off")
+
+    # Lane headings above the threats, barriers and consequences
+    headings = {}
+    for node_id, (x, _) in positions.items():
+        node = nodes[node_id]
+        if isinstance(node, Barrier):
+            headings[x] = "Preventive Barriers" if x < 0 else "Mitigative Barriers"
+        elif isinstance(node, (Threat, Consequence)):
+            headings[x] = "Threats" if isinstance(node, Threat) else "Consequences"
+    for x, heading in headings.items():
+        ax.text(x, max(ys) + 0.7, heading, ha="center", va="center", fontsize=9, fontweight="bold", color="#555555")
+
+    for source, target in bowtie_edges(diagram):
+        (x1, y1), (x2, y2) = positions[source], positions[target]
+        ax.plot((x1, x2), (y1, y2), color="#333333", linewidth=1, zorder=1)
+
+    for node_id, (x, y) in positions.items():
+        node = nodes[node_id]
+        fill, edge, edge_width, text_color = NODE_STYLES[type(node)]
+        box_style = "circle,pad=0.05" if isinstance(node, TopEvent) else "round,pad=0.05"
+        ax.add_patch(FancyBboxPatch(
+            (x - NODE_WIDTH / 2, y - NODE_HEIGHT / 2), NODE_WIDTH, NODE_HEIGHT,
+            boxstyle=box_style, facecolor=fill, edgecolor=edge, linewidth=edge_width, zorder=2,
+        ))
+        ax.text(x, y, wrap_text(node.name, words_per_line).replace("<br>", "\n"),
+                ha="center", va="center", fontsize=7, color=text_color, zorder=3)
+    return fig
+
+
+def render_bowtie(diagram, fmt, words_per_line=3, max_pixels=None):
+    """
+    Render the bowtie diagram to the given format and return the file contents.
+
+    With max_pixels, the resolution is lowered so the longest side of the figure stays within max_pixels pixels, which
+    bounds the time and memory of rasterizing large bowties.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format '{fmt}'")
+    fig = draw_bowtie(diagram, words_per_line)
+    dpi = EXPORT_DPI if max_pixels is None else min(EXPORT_DPI, max_pixels / max(fig.get_size_inches()))
+    if dpi < LABEL_DPI:
+        for ax in fig.axes:
+            for text in list(ax.texts):
+                text.remove()
+    try:
+        with io.BytesIO() as buffer:
+            fig.savefig(buffer, format=fmt, dpi=dpi)
+            return buffer.getvalue()
+    finally:
+        fig.clear()
+
+
+def export_bowtie(diagram, fmt, words_per_line=3, max_pixels=None):
+    """Return the rendered diagram, reusing the cached file when the diagram and options are unchanged."""
+    return _export_cache.get_or_create(
+        (diagram.content_hash(), fmt, words_per_line, max_pixels),
+        lambda: render_bowtie(diagram, fmt, words_per_line, max_pixels),
+    )
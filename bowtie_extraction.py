@@ -0,0 +1,274 @@
+"""
+Extraction of bowtie data from the agent's replies.
+
+The agent returns a new bowtie through the update_bowtie function call and changes to the current one through the
+patch_bowtie function call, whose patch operations refer to the node IDs the agent is shown. The JSON arguments are
+collected chunk by chunk while the reply streams. Replies that write the bowtie into the message text instead
+(`bowtie_data = {...}`) are still understood. The extracted data is repaired locally for common defects (code fences, trailing commas, Python literals,
+unclosed brackets) and validated against the bowtie schema, so a malformed reply does not need another round-trip to
+the model.
+"""
+import ast
+import copy
+import json
+import re
+
+from bowtie_model import Hazard
+
+# Function the agent calls to hand over the bowtie
+BOWTIE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "update_bowtie",
+        "description": "Update the bowtie diagram with the hazard, top events, threats, consequences and barriers "
+                       "the user has provided or accepted so far.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "hazard": {"type": "string"},
+                "top_events": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "top_event": {"type": "string"},
+                            "threats": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "threat": {"type": "string"},
+                                        "preventive_barriers": {"type": "array", "items": {"type": "string"}},
+                                    },
+                                    "required": ["threat", "preventive_barriers"],
+                                },
+                            },
+                            "consequences": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "consequence": {"type": "string"},
+                                        "mitigative_barriers": {"type": "array", "items": {"type": "string"}},
+                                    },
+                                    "required": ["consequence", "mitigative_barriers"],
+                                },
+                            },
+                        },
+                        "required": ["top_event", "threats", "consequences"],
+                    },
+                },
+            },
+            "required": ["hazard", "top_events"],
+        },
+    },
+}
+
+# Function the agent calls to change the current bowtie, see bowtie_model.Hazard.apply_patch
+PATCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "patch_bowtie",
+        "description": "Change the current bowtie with add, remove and rename operations on the node IDs shown in the "
+                       "current bowtie_data. Use this instead of update_bowtie once a bowtie exists.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "operations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "op": {"type": "string", "enum": ["add", "remove", "rename"]},
+                            "id": {"type": "string", "description": "Node to remove or rename"},
+                            "parent": {"type": "string", "description": "Node to add to"},
+                            "kind": {"type": "string", "enum": ["top_event", "threat", "consequence", "barrier"]},
+                            "name": {"type": "string"},
+                            "barriers": {"type": "array", "items": {"type": "string"},
+                                         "description": "Barriers of an added threat or consequence"},
+                        },
+                        "required": ["op"],
+                    },
+                },
+            },
+            "required": ["operations"],
+        },
+    },
+}
+
+AGENT_TOOLS = [BOWTIE_TOOL, PATCH_TOOL]
+
+_TEXT_MARKER = "bowtie_data"
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+class ExtractionError(ValueError):
+    """Raised when the bowtie data in a reply cannot be repaired or does not match the schema."""
+
+
+def _close_brackets(text):
+    # Append the closing brackets and quote a truncated JSON document is missing
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    return text + ('"' if in_string else "") + "".join(reversed(stack))
+
+
+def repair_json(text):
+    """Parse a JSON object from model output, repairing common defects. Raises ExtractionError if it cannot."""
+    text = text.strip()
+    # Drop a `bowtie_data =` prefix and anything before the object, and code fences after it
+    start = text.find("{")
+    if start == -1:
+        raise ExtractionError("no dictionary found")
+    text = text[start:].split("```")[0].strip()
+
+    candidates = [text, _TRAILING_COMMA.sub(r"\1", text)]
+    candidates.append(_close_brackets(_TRAILING_COMMA.sub(r"\1", candidates[-1])))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            pass
+        # Python dictionary syntax: single quotes, True/False/None
+        try:
+            return ast.literal_eval(candidate)
+        except (ValueError, SyntaxError):
+            pass
+    # Trailing text after the object: parse the first complete object only
+    try:
+        return json.JSONDecoder().raw_decode(candidates[1])[0]
+    except ValueError as e:
+        raise ExtractionError(f"invalid JSON: {e}") from e
+
+
+def _text_list(value):
+    # Barrier lists given as one `;`-separated string are split, empty entries dropped
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(";")
+    if not isinstance(value, list):
+        raise ExtractionError("barriers must be a list of strings")
+    return [str(v).strip() for v in value if v is not None and str(v).strip()]
+
+
+def validate_bowtie(data):
+    """Return the data normalized to the bowtie_data schema. Raises ExtractionError if it does not fit the schema."""
+    if not isinstance(data, dict):
+        raise ExtractionError("bowtie_data must be a dictionary")
+    top_events = data.get("top_events") or []
+    # A single top event given as a dictionary
+    if isinstance(top_events, dict):
+        top_events = [top_events]
+    if not isinstance(top_events, list) or not all(isinstance(te, dict) for te in top_events):
+        raise ExtractionError("top_events must be a list of dictionaries")
+
+    normalized = {"hazard": str(data.get("hazard") or "").strip(), "top_events": []}
+    for te in top_events:
+        threats = te.get("threats") or []
+        consequences = te.get("consequences") or []
+        if not all(isinstance(t, dict) for t in threats) or not all(isinstance(c, dict) for c in consequences):
+            raise ExtractionError("threats and consequences must be lists of dictionaries")
+        normalized["top_events"].append({
+            "top_event": str(te.get("top_event") or "").strip(),
+            "threats": [
+                {"threat": str(t.get("threat") or "").strip(), "preventive_barriers": _text_list(t.get("preventive_barriers"))}
+                for t in threats
+            ],
+            "consequences": [
+                {"consequence": str(c.get("consequence") or "").strip(), "mitigative_barriers": _text_list(c.get("mitigative_barriers"))}
+                for c in consequences
+            ],
+        })
+    return normalized
+
+
+def _operations(data):
+    # Patch arguments as a list of operations; a bare list or a single operation is accepted too. Barriers of added
+    # threats and consequences are normalized like those of update_bowtie.
+    if isinstance(data, dict) and "operations" in data:
+        data = data["operations"]
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise ExtractionError("operations must be a list")
+    return [
+        {**operation, "barriers": _text_list(operation["barriers"])}
+        if isinstance(operation, dict) and "barriers" in operation else operation
+        for operation in data
+    ]
+
+
+class BowtieExtractor:
+    """
+    Collects the bowtie and the patches to it from a streaming reply.
+
+    Wrap the text stream with watch() and pass feed_arguments as the tool call callback of llm_client.stream_chat.
+    """
+
+    def __init__(self):
+        self._text = []
+        # Function name and argument chunks per tool call index
+        self._calls = {}
+
+    def watch(self, chunks):
+        """Yield the text chunks unchanged while keeping them for the text fallback."""
+        for chunk in chunks:
+            self._text.append(chunk)
+            yield chunk
+
+    def feed_arguments(self, index, name, chunk):
+        """Collect a chunk of the arguments of a function call."""
+        call = self._calls.setdefault(index, [name, []])
+        call[0] = call[0] or name
+        call[1].append(chunk)
+
+    @property
+    def found(self):
+        """Whether the reply contained bowtie data or a patch."""
+        return bool(self._calls) or _TEXT_MARKER in "".join(self._text)
+
+    def apply(self, bowtie):
+        """
+        Return the bowtie after the changes of the reply, as a bowtie_model.Hazard.
+
+        A full update replaces the bowtie; patches are applied to a copy of it, so the given bowtie is left unchanged.
+        Raises ExtractionError if the reply is malformed or one of its patches does not apply.
+        """
+        calls = [self._calls[index] for index in sorted(self._calls)]
+        if not calls:
+            text = "".join(self._text)
+            return Hazard.from_dict(validate_bowtie(repair_json(text[text.find(_TEXT_MARKER):])))
+        # A reply can make several calls; they are applied to a copy, so a failing call does not leave the earlier ones
+        # applied to the caller's bowtie
+        copied = False
+        for name, chunks in calls:
+            data = repair_json("".join(chunks))
+            if name == PATCH_TOOL["function"]["name"]:
+                if bowtie is None:
+                    raise ExtractionError("there is no bowtie to patch yet")
+                if not copied:
+                    bowtie = copy.deepcopy(bowtie)
+                    copied = True
+                try:
+                    bowtie.apply_patch(_operations(data))
+                except ValueError as e:
+                    raise ExtractionError(str(e)) from e
+            else:
+                bowtie = Hazard.from_dict(validate_bowtie(data))
+                copied = True
+        return bowtie
@@ -0,0 +1,77 @@
+"""
+Deterministic bowtie layout for the Matplotlib and PDF views.
+
+Positions are computed directly from the bowtie structure in a single pass over the nodes, instead of running an
+iterative force-directed layout:
+
+    threats | preventive barrier lanes | top event | mitigative barrier lanes | consequences
+
+The hazard sits above its top events, and multiple top events are stacked in horizontal bands. Layouts are memoized on
+the content hash of the diagram, in a cache shared by all sessions and the thumbnail worker threads.
+"""
+from shared_cache import SharedCache
+
+# Maximum number of layouts kept in the layout cache, and their maximum estimated size in bytes
+LAYOUT_CACHE_SIZE = 32
+LAYOUT_CACHE_BYTES = 32 * 1024 * 1024
+
+# Horizontal distance between lanes and vertical distance between rows
+LANE_WIDTH = 1.0
+ROW_HEIGHT = 1.0
+
+_layout_cache = SharedCache("layout", LAYOUT_CACHE_SIZE, LAYOUT_CACHE_BYTES)
+
+
+def bowtie_edges(diagram):
+    """Return the (source, target) node ID pairs of the diagram, following the Mermaid diagram structure."""
+    edges = []
+    for top_event in diagram.top_events:
+        edges.append((diagram.id, top_event.id))
+        for threat in top_event.threats:
+            chain = [threat.id, *(b.id for b in threat.barriers), top_event.id]
+            edges += zip(chain, chain[1:])
+        for consequence in top_event.consequences:
+            chain = [top_event.id, *(b.id for b in consequence.barriers), consequence.id]
+            edges += zip(chain, chain[1:])
+    return edges
+
+
+def _compute(diagram):
+    positions = {}
+    top_events = diagram.top_events
+    # Number of barrier lanes on each side, shared by all top events so lanes line up
+    preventive_lanes = max((len(t.barriers) for te in top_events for t in te.threats), default=0)
+    mitigative_lanes = max((len(c.barriers) for te in top_events for c in te.consequences), default=0)
+    threat_x = -(preventive_lanes + 1) * LANE_WIDTH
+    consequence_x = (mitigative_lanes + 1) * LANE_WIDTH
+
+    top = 0.0
+    for top_event in top_events:
+        rows = max(len(top_event.threats), len(top_event.consequences), 1)
+        center = top - (rows - 1) * ROW_HEIGHT / 2
+        positions[top_event.id] = (0.0, center)
+
+        for side, branch_x, first_barrier_x in (
+            (top_event.threats, threat_x, threat_x + LANE_WIDTH),
+            (top_event.consequences, consequence_x, LANE_WIDTH),
+        ):
+            # Center each side on the top event
+            offset = center + (len(side) - 1) * ROW_HEIGHT / 2
+            for j, branch in enumerate(side):
+                y = offset - j * ROW_HEIGHT
+                positions[branch.id] = (branch_x, y)
+                # Barriers fill the lanes left to right in chain order: preventive barriers start next to their threat,
+                # mitigative barriers start next to the top event
+                for k, barrier in enumerate(branch.barriers):
+                    positions[barrier.id] = (first_barrier_x + k * LANE_WIDTH, y)
+
+        top -= (rows + 1) * ROW_HEIGHT
+
+    # Hazard above the first row
+    positions[diagram.id] = (0.0, ROW_HEIGHT)
+    return positions
+
+
+def bowtie_layout(diagram):
+    """Return the node positions of the diagram as a dictionary of node ID to (x, y), reusing cached layouts."""
+    return _layout_cache.get_or_create((diagram.content_hash(), tuple(diagram.nodes())), lambda: _compute(diagram))
@@ -0,0 +1,380 @@
+"""
+In-memory bowtie model shared by all tabs of the app.
+
+A bowtie is held as a tree of slotted dataclasses rooted at a Hazard. Every node carries a stable ID, and the hazard keeps
+an index of its nodes so any element can be looked up by ID in constant time. Changes from the agent are applied as patch
+operations (add, remove, rename) addressed by node ID, touching only the affected nodes. Conversion to and from the JSON
+schema used by the agent, the import/export files and the diagram code is lossless:
+
+    { "hazard": "", "top_events": [ { "top_event": "", "threats": [ { "threat": "", "preventive_barriers": [""] } ],
+      "consequences": [ { "consequence": "", "mitigative_barriers": [""] } ] } ] }
+"""
+import hashlib
+import json
+import re
+from dataclasses import dataclass, field
+
+# Prefixes used for the node IDs of each element type
+ID_PREFIXES = {
+    "Hazard": "H",
+    "TopEvent": "E",
+    "Threat": "T",
+    "Consequence": "C",
+    "Barrier": "B",
+}
+
+_ID_PATTERN = re.compile(r"^[A-Z]+(\d+)$")
+
+
+@dataclass(slots=True)
+class Barrier:
+    name: str
+    id: str = ""
+
+
+@dataclass(slots=True)
+class Threat:
+    name: str
+    barriers: list = field(default_factory=list)
+    id: str = ""
+
+
+@dataclass(slots=True)
+class Consequence:
+    name: str
+    barriers: list = field(default_factory=list)
+    id: str = ""
+
+
+@dataclass(slots=True)
+class TopEvent:
+    name: str
+    threats: list = field(default_factory=list)
+    consequences: list = field(default_factory=list)
+    id: str = ""
+
+
+@dataclass(slots=True)
+class Hazard:
+    name: str
+    top_events: list = field(default_factory=list)
+    id: str = ""
+    _nodes: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+    _parents: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+    _next_id: int = field(default=1, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.reindex()
+
+    #################################################################################################################
+    # NODE IDS AND LOOKUP
+    #################################################################################################################
+
+    def reindex(self):
+        """Rebuild the ID index, keeping existing IDs and assigning new ones to nodes without one."""
+        self._nodes = {}
+        self._parents = {}
+        nodes = list(self._walk())
+        # Continue numbering after the highest existing ID so that IDs are never reused
+        for node, _ in nodes:
+            match = _ID_PATTERN.match(node.id)
+            if match:
+                self._next_id = max(self._next_id, int(match.group(1)) + 1)
+        for node, parent in nodes:
+            if not node.id or node.id in self._nodes:
+                node.id = self._new_id(node)
+            self._nodes[node.id] = node
+            self._parents[node.id] = parent
+        return self
+
+    def register(self, node, parent):
+        """Assign an ID to a newly attached node (and its children) and add it to the index."""
+        stack = [(node, parent)]
+        while stack:
+            current, current_parent = stack.pop()
+            if not current.id or current.id in self._nodes:
+                current.id = self._new_id(current)
+            self._nodes[current.id] = current
+            self._parents[current.id] = current_parent
+            stack.extend((child, current) for child in reversed(_children(current)))
+        return node
+
+    def unregister(self, node):
+        """Remove a detached node (and its children) from the index."""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            self._nodes.pop(current.id, None)
+            self._parents.pop(current.id, None)
+            stack.extend(_children(current))
+
+    def get(self, node_id):
+        """Return the node with the given ID, or None."""
+        return self._nodes.get(node_id)
+
+    def parent(self, node_id):
+        """Return the parent of the node with the given ID, or None for the hazard itself."""
+        return self._parents.get(node_id)
+
+    def nodes(self):
+        """Return all nodes in the bowtie, keyed by ID."""
+        return dict(self._nodes)
+
+    def _new_id(self, node):
+        node_id = f"{ID_PREFIXES[type(node).__name__]}{self._next_id}"
+        self._next_id += 1
+        return node_id
+
+    def _walk(self):
+        stack = [(self, None)]
+        while stack:
+            node, parent = stack.pop()
+            yield node, parent
+            stack.extend((child, node) for child in reversed(_children(node)))
+
+    #################################################################################################################
+    # PATCH OPERATIONS
+    #################################################################################################################
+
+    def add(self, parent_id, kind, name, barriers=()):
+        """
+        Add a top event, threat, consequence or barrier under the node with the given ID and return it.
+
+        Top events are added to the hazard, threats and consequences to a top event, barriers to a threat or
+        consequence. Threats and consequences can be added together with their barriers.
+        """
+        parent = self._patch_target(parent_id)
+        if kind not in _CHILD_LISTS or not isinstance(parent, _CHILD_LISTS[kind][0]):
+            raise ValueError(f"Cannot add a {kind} to {parent_id}")
+        if kind == "top_event":
+            node = TopEvent(name)
+        elif kind == "barrier":
+            node = Barrier(name)
+        else:
+            node_type = Threat if kind == "threat" else Consequence
+            node = node_type(name, barriers=[Barrier(_text(b)) for b in barriers])
+        getattr(parent, _CHILD_LISTS[kind][1]).append(node)
+        return self.register(node, parent)
+
+    def remove(self, node_id):
+        """Remove the node with the given ID and everything below it, and return it."""
+        node = self._patch_target(node_id)
+        if node is self:
+            raise ValueError("Cannot remove the hazard")
+        parent = self._parents[node_id]
+        for _, attribute in _CHILD_LISTS.values():
+            children = getattr(parent, attribute, None)
+            if children is not None and any(child is node for child in children):
+                children[:] = [child for child in children if child is not node]
+        self.unregister(node)
+        return node
+
+    def rename(self, node_id, name):
+        """Rename the node with the given ID and return it."""
+        node = self._patch_target(node_id)
+        node.name = name
+        return node
+
+    def apply_patch(self, operations):
+        """
+        Apply a list of patch operations in order and return the bowtie.
+
+        Each operation is a dictionary {"op": "add", "parent": <id>, "kind": <kind>, "name": <name>, "barriers": [...]},
+        {"op": "remove", "id": <id>} or {"op": "rename", "id": <id>, "name": <name>}. All operations are checked
+        before any is applied, so a patch with an invalid operation leaves the bowtie unchanged.
+        """
+        if not isinstance(operations, list) or not all(isinstance(o, dict) for o in operations):
+            raise ValueError("operations must be a list of dictionaries")
+        # Node IDs of the operations refer to nodes that exist before the patch, so they can be checked up front
+        removed = set()
+        for operation in operations:
+            op = operation.get("op")
+            node_id = operation.get("parent") if op == "add" else operation.get("id")
+            if op not in ("add", "remove", "rename"):
+                raise ValueError(f"Unknown patch operation: {op}")
+            if node_id not in self._nodes or self._removed(node_id, removed):
+                raise ValueError(f"Unknown node ID in {op} operation: {node_id}")
+            if op != "remove" and not _text(operation.get("name")).strip():
+                raise ValueError(f"Missing name in {op} operation on {node_id}")
+            if op == "remove":
+                if node_id == self.id:
+                    raise ValueError("Cannot remove the hazard")
+                removed.add(node_id)
+            if op == "add":
+                kind = operation.get("kind")
+                if kind not in _CHILD_LISTS or not isinstance(self._nodes[node_id], _CHILD_LISTS[kind][0]):
+                    raise ValueError(f"Cannot add a {kind} to {node_id}")
+                if not isinstance(operation.get("barriers") or [], list):
+                    raise ValueError(f"Barriers of the {kind} added to {node_id} must be a list")
+
+        for operation in operations:
+            op = operation["op"]
+            if op == "add":
+                barriers = [b for b in operation.get("barriers") or [] if _text(b).strip()]
+                self.add(operation["parent"], operation["kind"], _text(operation["name"]).strip(), barriers)
+            elif op == "remove":
+                self.remove(operation["id"])
+            else:
+                self.rename(operation["id"], _text(operation["name"]).strip())
+        return self
+
+    def _patch_target(self, node_id):
+        node = self._nodes.get(node_id)
+        if node is None:
+            raise ValueError(f"Unknown node ID: {node_id}")
+        return node
+
+    def _removed(self, node_id, removed):
+        # Whether the node or one of its ancestors is removed earlier in the patch
+        while node_id is not None:
+            if node_id in removed:
+                return True
+            parent = self._parents.get(node_id)
+            node_id = parent.id if parent is not None else None
+        return False
+
+    #################################################################################################################
+    # JSON SCHEMA CONVERSION
+    #################################################################################################################
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a bowtie from the bowtie_data dictionary schema, keeping the node IDs of the to_dict(ids=True) form."""
+        if not isinstance(data, dict):
+            raise ValueError("bowtie_data must be a dictionary")
+        top_events = data.get("top_events") or []
+        if not isinstance(top_events, list):
+            raise ValueError("top_events must be a list")
+        return cls(
+            name=_text(data.get("hazard")),
+            id=_text(data.get("id")),
+            top_events=[
+                TopEvent(
+                    name=_text(te.get("top_event")),
+                    id=_text(te.get("id")),
+                    threats=[
+                        Threat(
+                            name=_text(t.get("threat")),
+                            id=_text(t.get("id")),
+                            barriers=[_barrier(b) for b in t.get("preventive_barriers") or []],
+                        )
+                        for t in te.get("threats") or []
+                    ],
+                    consequences=[
+                        Consequence(
+                            name=_text(c.get("consequence")),
+                            id=_text(c.get("id")),
+                            barriers=[_barrier(b) for b in c.get("mitigative_barriers") or []],
+                        )
+                        for c in te.get("consequences") or []
+                    ],
+                )
+                for te in top_events
+            ],
+        )
+
+    def content_hash(self):
+        """Return a hash of the bowtie content in the dictionary schema, independent of node IDs."""
+        payload = json.dumps(self.to_dict(), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def to_dict(self, ids=False):
+        """
+        Return the bowtie in the bowtie_data dictionary schema.
+
+        With ids=True every element also carries its node ID, and barriers become {"id": ..., "name": ...}
+        dictionaries. This is the form sent to the agent, so that its patch operations can refer to the nodes.
+        """
+        if not ids:
+            return {
+                "hazard": self.name,
+                "top_events": [
+                    {
+                        "top_event": te.name,
+                        "threats": [
+                            {"threat": t.name, "preventive_barriers": [b.name for b in t.barriers]}
+                            for t in te.threats
+                        ],
+                        "consequences": [
+                            {"consequence": c.name, "mitigative_barriers": [b.name for b in c.barriers]}
+                            for c in te.consequences
+                        ],
+                    }
+                    for te in self.top_events
+                ],
+            }
+        return {
+            "id": self.id,
+            "hazard": self.name,
+            "top_events": [
+                {
+                    "id": te.id,
+                    "top_event": te.name,
+                    "threats": [
+                        {"id": t.id, "threat": t.name,
+                         "preventive_barriers": [{"id": b.id, "name": b.name} for b in t.barriers]}
+                        for t in te.threats
+                    ],
+                    "consequences": [
+                        {"id": c.id, "consequence": c.name,
+                         "mitigative_barriers": [{"id": b.id, "name": b.name} for b in c.barriers]}
+                        for c in te.consequences
+                    ],
+                }
+                for te in self.top_events
+            ],
+        }
+
+
+# Parent type and child list of each kind of node the patch operations can add
+_CHILD_LISTS = {
+    "top_event": (Hazard, "top_events"),
+    "threat": (TopEvent, "threats"),
+    "consequence": (TopEvent, "consequences"),
+    "barrier": ((Threat, Consequence), "barriers"),
+}
+
+
+def _children(node):
+    if isinstance(node, Hazard):
+        return node.top_events
+    if isinstance(node, TopEvent):
+        return [*node.threats, *node.consequences]
+    if isinstance(node, (Threat, Consequence)):
+        return node.barriers
+    return []
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+
+def _barrier(value):
+    # Barriers are names, or {"id": ..., "name": ...} dictionaries in the form with node IDs
+    if isinstance(value, dict):
+        return Barrier(_text(value.get("name")), _text(value.get("id")))
+    return Barrier(_text(value))
+
+
+@dataclass(slots=True)
+class Workspace:
+    """
+    A collection of bowties, one per hazard.
+
+    The JSON schema of a workspace is { "bowties": [ <bowtie_data>, ... ] }.
+    """
+    hazards: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a workspace from the workspace schema, or from a single bowtie_data dictionary."""
+        if isinstance(data, dict) and "bowties" in data:
+            bowties = data["bowties"]
+            if not isinstance(bowties, list):
+                raise ValueError("bowties must be a list")
+            return cls([Hazard.from_dict(b) for b in bowties])
+        return cls([Hazard.from_dict(data)])
+
+    def to_dict(self):
+        """Return the workspace in the workspace schema."""
+        return {"bowties": [h.to_dict() for h in self.hazards]}
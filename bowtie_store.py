@@ -0,0 +1,389 @@
+"""
+Persistent library of bowties in a local SQLite database.
+
+Every save of a bowtie adds a version when its content changed, and the chat history of the bowtie is stored with it.
+The bowties table holds one summary row per bowtie, indexed by hazard, and the top events of the latest version are
+indexed separately, so the library can be listed and filtered without loading any bowtie; a bowtie is only read and
+parsed when it is opened. The database runs in WAL mode with a busy timeout, so several Streamlit workers can read and
+write it at the same time.
+
+Every element of the latest version of each bowtie is also kept in an inverted index: a nodes table with the normalized
+name of each hazard, top event, threat, consequence and barrier, mirrored into an FTS5 full-text index. Barriers are
+mapped to canonical barriers (see barrier_canon), whose IDs are kept in the database so they stay the same across
+sessions and workers, and running usage counts are kept per canonical barrier. Searches, "where is this barrier used"
+queries and barrier frequency statistics are answered from the indexes without loading any bowtie.
+
+The database file is bowtie_library.db in the working directory unless BOWTIE_STORE_PATH is set.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+from barrier_canon import BarrierCanonicalizer, canonical_key, normalize_name
+from bowtie_model import Barrier, Consequence, Hazard, Threat, TopEvent
+
+STORE_PATH = "bowtie_library.db"
+# Milliseconds a writer waits for another worker's transaction before failing
+BUSY_TIMEOUT = 5000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bowties (
+    id INTEGER PRIMARY KEY,
+    hazard TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    top_event_count INTEGER NOT NULL,
+    node_count INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bowties_hazard ON bowties (hazard COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS bowties_updated ON bowties (updated);
+
+CREATE TABLE IF NOT EXISTS versions (
+    bowtie_id INTEGER NOT NULL REFERENCES bowties (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (bowtie_id, version)
+);
+
+CREATE TABLE IF NOT EXISTS top_events (
+    bowtie_id INTEGER NOT NULL REFERENCES bowties (id) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS top_events_name ON top_events (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS top_events_bowtie ON top_events (bowtie_id);
+
+CREATE TABLE IF NOT EXISTS nodes (
+    bowtie_id INTEGER NOT NULL REFERENCES bowties (id) ON DELETE CASCADE,
+    node_id TEXT NOT NULL,
+    parent_id TEXT,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    normalized TEXT NOT NULL,
+    canonical_id TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_bowtie ON nodes (bowtie_id, node_id);
+CREATE INDEX IF NOT EXISTS nodes_canonical ON nodes (canonical_id);
+
+-- Full-text index over the node names, kept in sync with the nodes table by triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts USING fts5 (
+    name, content='nodes', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS nodes_fts_insert AFTER INSERT ON nodes BEGIN
+    INSERT INTO nodes_fts (rowid, name) VALUES (new.rowid, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS nodes_fts_delete AFTER DELETE ON nodes BEGIN
+    INSERT INTO nodes_fts (nodes_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+END;
+
+-- Canonical barrier of every barrier name key seen so far
+CREATE TABLE IF NOT EXISTS barrier_canon (
+    key TEXT PRIMARY KEY,
+    canonical_id TEXT NOT NULL,
+    canonical_name TEXT NOT NULL
+);
+
+-- Number of barrier nodes and of bowties using each canonical barrier
+CREATE TABLE IF NOT EXISTS barrier_stats (
+    canonical_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    uses INTEGER NOT NULL,
+    bowties INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS barrier_stats_uses ON barrier_stats (uses);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    bowtie_id INTEGER NOT NULL REFERENCES bowties (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (bowtie_id, position)
+);
+"""
+
+
+# Node kinds of the index
+NODE_KINDS = {Hazard: "hazard", TopEvent: "top_event", Threat: "threat", Consequence: "consequence", Barrier: "barrier"}
+
+def _fts_query(text):
+    # Every word of the text as a quoted prefix term, so "emerg shut" finds "Emergency shutdown"
+    return " ".join(f'"{word}"*' for word in normalize_name(text).split())
+
+
+def _prefix_pattern(text):
+    # LIKE pattern matching the prefix literally; case-insensitive LIKE can use the NOCASE indexes
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%"
+
+
+class BowtieStore:
+    def __init__(self, path=STORE_PATH):
+        self.path = str(path)
+        # sqlite3 connections may not be shared between threads, and Streamlit runs each session on its own thread
+        self._local = threading.local()
+        # Canonical barriers shared by the threads of this process, and the last barrier_canon row loaded into them
+        self._canon = BarrierCanonicalizer()
+        self._canon_rowid = 0
+        self._canon_lock = threading.Lock()
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+        # Index bowties saved before the index existed; every indexed bowtie has at least its hazard node
+        unindexed = [row[0] for row in self._connection().execute(
+            "SELECT id FROM bowties WHERE NOT EXISTS (SELECT 1 FROM nodes WHERE nodes.bowtie_id = bowties.id)"
+        )]
+        for bowtie_id in unindexed:
+            connection = self._connection()
+            with connection:
+                self._index(connection, bowtie_id, self.load(bowtie_id))
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+            self._local.connection = connection
+        return connection
+
+    def save(self, bowtie, bowtie_id=None, messages=None):
+        """
+        Save a bowtie_model.Hazard and return its ID in the library.
+
+        Without bowtie_id, or if that bowtie no longer exists, the bowtie is added to the library. Otherwise a new version
+        is added when the content changed. The chat history is replaced by the given messages unless they are None.
+        """
+        content_hash = bowtie.content_hash()
+        data = json.dumps(bowtie.to_dict(ids=True), ensure_ascii=False, separators=(",", ":"))
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # Take the write lock up front so concurrent saves of the same bowtie get distinct version numbers
+            connection.execute("BEGIN IMMEDIATE")
+            row = None
+            if bowtie_id is not None:
+                row = connection.execute("SELECT version, content_hash FROM bowties WHERE id = ?", (bowtie_id,)).fetchone()
+            if row is None:
+                bowtie_id = connection.execute(
+                    "INSERT INTO bowties (hazard, version, content_hash, top_event_count, node_count, updated) "
+                    "VALUES (?, 1, ?, ?, ?, ?)",
+                    (bowtie.name, content_hash, len(bowtie.top_events), len(bowtie.nodes()), now),
+                ).lastrowid
+                version = 1
+            elif row["content_hash"] != content_hash:
+                version = row["version"] + 1
+                connection.execute(
+                    "UPDATE bowties SET hazard = ?, version = ?, content_hash = ?, top_event_count = ?, node_count = ?, "
+                    "updated = ? WHERE id = ?",
+                    (bowtie.name, version, content_hash, len(bowtie.top_events), len(bowtie.nodes()), now, bowtie_id),
+                )
+                connection.execute("DELETE FROM top_events WHERE bowtie_id = ?", (bowtie_id,))
+            else:
+                version = None
+            if version is not None:
+                connection.execute(
+                    "INSERT INTO versions (bowtie_id, version, content_hash, data, created) VALUES (?, ?, ?, ?, ?)",
+                    (bowtie_id, version, content_hash, data, now),
+                )
+                connection.executemany(
+                    "INSERT INTO top_events (bowtie_id, name) VALUES (?, ?)",
+                    [(bowtie_id, te.name) for te in bowtie.top_events],
+                )
+                self._index(connection, bowtie_id, bowtie)
+            if messages is not None:
+                connection.execute("DELETE FROM chat_messages WHERE bowtie_id = ?", (bowtie_id,))
+                connection.executemany(
+                    "INSERT INTO chat_messages (bowtie_id, position, role, content) VALUES (?, ?, ?, ?)",
+                    [(bowtie_id, position, m["role"], m["content"]) for position, m in enumerate(messages)],
+                )
+        return bowtie_id
+
+    def load(self, bowtie_id, version=None):
+        """Return the given or latest version of a bowtie as a bowtie_model.Hazard, or None if it does not exist."""
+        if version is None:
+            row = self._connection().execute(
+                "SELECT v.data FROM bowties b JOIN versions v ON v.bowtie_id = b.id AND v.version = b.version "
+                "WHERE b.id = ?", (bowtie_id,),
+            ).fetchone()
+        else:
+            row = self._connection().execute(
+                "SELECT data FROM versions WHERE bowtie_id = ? AND version = ?", (bowtie_id, version),
+            ).fetchone()
+        return Hazard.from_dict(json.loads(row["data"])) if row else None
+
+    def load_messages(self, bowtie_id):
+        """Return the chat history stored with a bowtie."""
+        rows = self._connection().execute(
+            "SELECT role, content FROM chat_messages WHERE bowtie_id = ? ORDER BY position", (bowtie_id,),
+        )
+        return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+    def versions(self, bowtie_id):
+        """Return the versions of a bowtie, newest first, as dictionaries with the version number and creation time."""
+        rows = self._connection().execute(
+            "SELECT version, created FROM versions WHERE bowtie_id = ? ORDER BY version DESC", (bowtie_id,),
+        )
+        return [dict(row) for row in rows]
+
+    def _where(self, hazard, top_event):
+        clauses, parameters = [], []
+        if hazard:
+            clauses.append("hazard LIKE ? ESCAPE '\\'")
+            parameters.append(_prefix_pattern(hazard))
+        if top_event:
+            clauses.append("id IN (SELECT bowtie_id FROM top_events WHERE name LIKE ? ESCAPE '\\')")
+            parameters.append(_prefix_pattern(top_event))
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+    def list_bowties(self, hazard=None, top_event=None, limit=50, offset=0):
+        """
+        Return summaries of the bowties whose hazard and one of whose top events start with the given texts, most
+        recently updated first. Each summary is a dictionary with the ID, hazard, version, content hash, top event and
+        node counts and the update time.
+        """
+        where, parameters = self._where(hazard, top_event)
+        rows = self._connection().execute(
+            "SELECT id, hazard, version, content_hash, top_event_count, node_count, updated FROM bowties"
+            f"{where} ORDER BY updated DESC LIMIT ? OFFSET ?",
+            (*parameters, limit, offset),
+        )
+        return [dict(row) for row in rows]
+
+    def count(self, hazard=None, top_event=None):
+        """Return the number of bowties list_bowties() would return without a limit."""
+        where, parameters = self._where(hazard, top_event)
+        return self._connection().execute(f"SELECT COUNT(*) FROM bowties{where}", parameters).fetchone()[0]
+
+    #################################################################################################################
+    # INVERTED INDEX
+    #################################################################################################################
+
+    def _sync_canon(self, connection):
+        # Load canonical barriers added by other workers; call with self._canon_lock held
+        rows = connection.execute(
+            "SELECT rowid, key, canonical_id, canonical_name FROM barrier_canon WHERE rowid > ? ORDER BY rowid",
+            (self._canon_rowid,),
+        ).fetchall()
+        for row in rows:
+            self._canon.register(row["key"], row["canonical_id"], row["canonical_name"])
+            self._canon_rowid = row["rowid"]
+
+    def _index(self, connection, bowtie_id, bowtie):
+        # Replace the indexed nodes of a bowtie and update the barrier usage counts. Runs inside
+        # a write transaction, so canonical barriers are assigned by one worker at a time.
+        old = Counter(dict(connection.execute(
+            "SELECT canonical_id, COUNT(*) FROM nodes WHERE bowtie_id = ? AND kind = 'barrier' GROUP BY canonical_id",
+            (bowtie_id,),
+        ).fetchall()))
+        connection.execute("DELETE FROM nodes WHERE bowtie_id = ?", (bowtie_id,))
+        rows = []
+        names = {}
+        with self._canon_lock:
+            self._sync_canon(connection)
+            for node_id, node in bowtie.nodes().items():
+                parent = bowtie.parent(node_id)
+                canonical_id = None
+                if isinstance(node, Barrier) and node.name.strip():
+                    canonical_id, names[canonical_id] = self._canon.add(node.name)
+                    connection.execute(
+                        "INSERT OR IGNORE INTO barrier_canon (key, canonical_id, canonical_name) VALUES (?, ?, ?)",
+                        (canonical_key(node.name), canonical_id, names[canonical_id]),
+                    )
+                rows.append((bowtie_id, node_id, parent.id if parent is not None else None, NODE_KINDS[type(node)],
+                             node.name, normalize_name(node.name), canonical_id))
+        connection.executemany(
+            "INSERT INTO nodes (bowtie_id, node_id, parent_id, kind, name, normalized, canonical_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows,
+        )
+        new = Counter(row[6] for row in rows if row[6] is not None)
+        for canonical_id in old.keys() | new.keys():
+            uses = new[canonical_id] - old[canonical_id]
+            bowties = (canonical_id in new) - (canonical_id in old)
+            if not uses and not bowties:
+                continue
+            connection.execute(
+                "INSERT INTO barrier_stats (canonical_id, name, uses, bowties) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (canonical_id) DO UPDATE SET uses = uses + excluded.uses, bowties = bowties + excluded.bowties",
+                (canonical_id, names.get(canonical_id, ""), uses, bowties),
+            )
+        connection.execute("DELETE FROM barrier_stats WHERE uses <= 0")
+
+    def canonical_barriers(self, names):
+        """
+        Return the canonical barrier of each name as a dictionary of (canonical ID, canonical name) pairs.
+
+        Names are matched against the canonical barriers of the library; names matching none of them are clustered
+        among themselves. Nothing is stored.
+        """
+        with self._canon_lock:
+            self._sync_canon(self._connection())
+            unknown = BarrierCanonicalizer(self._canon.threshold)
+            return {name: self._canon.match(name) or unknown.add(name) for name in names if name.strip()}
+
+    def search(self, text, kinds=None, limit=50):
+        """
+        Return the elements of all stored bowties whose names contain words starting with the words of the text, best
+        matches first. Each result is a dictionary with the bowtie ID and hazard, the node ID, kind and name, and the name
+        of the parent element. kinds restricts the results to some of the NODE_KINDS values.
+        """
+        query = _fts_query(text)
+        if not query:
+            return []
+        kind_filter = f" AND n.kind IN ({', '.join('?' * len(kinds))})" if kinds else ""
+        rows = self._connection().execute(
+            "SELECT n.bowtie_id, b.hazard, n.node_id, n.kind, n.name, p.name AS parent FROM nodes_fts "
+            "JOIN nodes n ON n.rowid = nodes_fts.rowid JOIN bowties b ON b.id = n.bowtie_id "
+            "LEFT JOIN nodes p ON p.bowtie_id = n.bowtie_id AND p.node_id = n.parent_id "
+            f"WHERE nodes_fts MATCH ?{kind_filter} ORDER BY nodes_fts.rank LIMIT ?",
+            (query, *(kinds or ()), limit),
+        )
+        return [dict(row) for row in rows]
+
+    def where_used(self, barrier, limit=200):
+        """
+        Return where a barrier is used across all stored bowties, including the variants of its name that belong to the
+        same canonical barrier. Each result is a dictionary with the bowtie ID and hazard, the barrier's node ID and
+        name as written, the threat or consequence it belongs to and that element's kind.
+        """
+        with self._canon_lock:
+            self._sync_canon(self._connection())
+            canonical = self._canon.match(barrier)
+        if canonical is None:
+            return []
+        rows = self._connection().execute(
+            "SELECT n.bowtie_id, b.hazard, n.node_id, n.name, p.name AS parent, p.kind AS parent_kind FROM nodes n "
+            "JOIN bowties b ON b.id = n.bowtie_id "
+            "LEFT JOIN nodes p ON p.bowtie_id = n.bowtie_id AND p.node_id = n.parent_id "
+            "WHERE n.canonical_id = ? ORDER BY b.updated DESC LIMIT ?",
+            (canonical[0], limit),
+        )
+        return [dict(row) for row in rows]
+
+    def barrier_frequency(self, limit=50):
+        """
+        Return the most used canonical barriers across all stored bowties, as dictionaries with the canonical ID and
+        name, the number of times it is used and the number of bowties using it.
+        """
+        rows = self._connection().execute(
+            "SELECT canonical_id, name, uses, bowties FROM barrier_stats ORDER BY uses DESC LIMIT ?", (limit,),
+        )
+        return [dict(row) for row in rows]
+
+
+@lru_cache(maxsize=8)
+def get_store(path=STORE_PATH):
+    """Return the store for the database file, shared by all sessions of the process."""
+    return BowtieStore(path)
+
+
+def store_from_env():
+    """Return the store at BOWTIE_STORE_PATH, or at bowtie_library.db in the working directory."""
+    return get_store(os.environ.get("BOWTIE_STORE_PATH") or STORE_PATH)
@@ -0,0 +1,303 @@
+"""
+Excel import and export of bowtie data.
+
+Workbooks are either parsed in one pass with pandas (import_excel) or, for very large barrier registers, streamed row
+by row with openpyxl in read-only mode (stream_excel) so that memory stays bounded. They are written with openpyxl in
+write-only mode (write_excel), which streams the rows to the file instead of building the workbook in memory.
+
+The workbook layout is:
+    Threats:      columns `Threat` and `Preventive Barriers`
+    Consequences: columns `Consequence` and `Mitigative Barriers`
+    Info:         optional, hazard in cell B1, top event in cell B2 and, in workbooks of several bowties, the bowtie
+                  number in cell B3
+Barriers are separated by `;` within a cell. Further top events follow as numbered sheet sets (`Threats 2`,
+`Consequences 2`, `Info 2`, ...). A set belongs to the bowtie numbered in its Info sheet, or to the bowtie of the set
+before it; top events of the same bowtie share its hazard.
+"""
+import copy
+import hashlib
+import io
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+
+from bowtie_model import Barrier, Consequence, Hazard, Threat, TopEvent
+from shared_cache import SharedCache
+
+# Maximum number of parsed workbooks kept in the import cache, and their maximum estimated size in bytes
+IMPORT_CACHE_SIZE = 16
+IMPORT_CACHE_BYTES = 128 * 1024 * 1024
+# Default maximum number of threat plus consequence rows accepted by the streaming import
+STREAM_ROW_LIMIT = 100_000
+# Number of rows between progress callbacks of the streaming import
+STREAM_PROGRESS_STEP = 500
+
+# Parsed workbooks shared by all sessions
+_import_cache = SharedCache("excel_import", IMPORT_CACHE_SIZE, IMPORT_CACHE_BYTES)
+
+
+def split_barriers(column):
+    # Split a column of `;`-separated barriers into one list per row, using vectorized string operations
+    parts = column.fillna("").astype(str).str.split(";").explode().str.strip()
+    parts = parts[parts != ""]
+    grouped = parts.groupby(level=0, sort=False).agg(list)
+    return grouped.reindex(column.index).apply(lambda b: b if isinstance(b, list) else []).tolist()
+
+
+def _sheet_frame(raw, name_column, barrier_column):
+    # Sheets are read without a header so the Info sheet keeps its first row; promote the first row for the others.
+    # Rows without a name and barriers are dropped, as the streaming import skips them.
+    if raw.empty:
+        raise ValueError("Worksheet has no header row")
+    frame = raw.iloc[1:].reset_index(drop=True)
+    frame.columns = [str(c).strip() for c in raw.iloc[0]]
+    for column in (name_column, barrier_column):
+        if column not in frame.columns:
+            raise ValueError(f"Worksheet has no '{column}' column")
+    blank = frame[[name_column, barrier_column]].isna().all(axis=1)
+    return frame[~blank].reset_index(drop=True)
+
+
+def _info_value(df_info, row):
+    try:
+        value = df_info.iloc[row, 1]
+    except IndexError:
+        return None
+    return None if pd.isna(value) else str(value)
+
+
+def sheet_names(number):
+    """Return the Threats, Consequences and Info sheet names of the given sheet set, counting from 1."""
+    suffix = "" if number == 1 else f" {number}"
+    return f"Threats{suffix}", f"Consequences{suffix}", f"Info{suffix}"
+
+
+def _bowtie_number(value, previous):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return previous
+
+
+def parse_workbook(data):
+    """
+    Parse the workbook bytes into a list of bowties in the bowtie_data dictionary schema, one per bowtie number.
+
+    All sheets are read in a single pass. The hazard and top event are None when a sheet set has no Info sheet.
+    """
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None)
+    for name in sheet_names(1)[:2]:
+        if name not in sheets:
+            raise ValueError(f"Worksheet named '{name}' not found")
+
+    bowties = {}
+    number, bowtie = 1, 1
+    while sheet_names(number)[0] in sheets:
+        threats_name, consequences_name, info_name = sheet_names(number)
+        if consequences_name not in sheets:
+            raise ValueError(f"Worksheet named '{consequences_name}' not found")
+        df_threats = _sheet_frame(sheets[threats_name], "Threat", "Preventive Barriers")
+        df_conseq = _sheet_frame(sheets[consequences_name], "Consequence", "Mitigative Barriers")
+
+        threats = [
+            {"threat": threat, "preventive_barriers": barriers}
+            for threat, barriers in zip(
+                df_threats["Threat"].fillna("").astype(str).tolist(),
+                split_barriers(df_threats["Preventive Barriers"]),
+            )
+        ]
+        consequences = [
+            {"consequence": consequence, "mitigative_barriers": barriers}
+            for consequence, barriers in zip(
+                df_conseq["Consequence"].fillna("").astype(str).tolist(),
+                split_barriers(df_conseq["Mitigative Barriers"]),
+            )
+        ]
+
+        df_info = sheets.get(info_name)
+        hazard = _info_value(df_info, 0) if df_info is not None else None
+        if df_info is not None:
+            bowtie = _bowtie_number(_info_value(df_info, 2), bowtie)
+        entry = bowties.setdefault(bowtie, {"hazard": hazard, "top_events": []})
+        entry["top_events"].append({
+            "top_event": _info_value(df_info, 1) if df_info is not None else None,
+            "threats": threats,
+            "consequences": consequences,
+        })
+        number += 1
+    return list(bowties.values())
+
+
+def parse_excel(data):
+    """
+    Parse the workbook bytes into the bowtie_data dictionary schema, with all top events of its first bowtie.
+
+    The hazard and top event are None when the workbook has no Info sheet.
+    """
+    return parse_workbook(data)[0]
+
+
+def _cached_workbook(data):
+    return _import_cache.get_or_create(hashlib.sha1(data).hexdigest(), lambda: parse_workbook(data))
+
+
+def import_excel(data):
+    """Return the first bowtie of the parsed workbook, reusing the cached result when the same file bytes were imported before."""
+    # Callers may edit the result, so never hand out the cached dictionary itself
+    return copy.deepcopy(_cached_workbook(data)[0])
+
+
+def import_workbook(data):
+    """Return all bowties of the parsed workbook as a list, reusing the cached result like import_excel."""
+    return copy.deepcopy(_cached_workbook(data))
+
+
+def _split_cell(value):
+    return [b.strip() for b in str(value).split(";") if b.strip()] if value is not None else []
+
+
+def _iter_sheet(workbook, sheet_name, name_column, barrier_column):
+    # Yield (name, barriers) for every data row of the sheet without loading the sheet into memory
+    if sheet_name not in workbook.sheetnames:
+        raise ValueError(f"Worksheet named '{sheet_name}' not found")
+    rows = workbook[sheet_name].iter_rows(values_only=True)
+    header = [str(c).strip() if c is not None else "" for c in next(rows, ())]
+    for column in (name_column, barrier_column):
+        if column not in header:
+            raise ValueError(f"Worksheet '{sheet_name}' has no '{column}' column")
+    name_index = header.index(name_column)
+    barrier_index = header.index(barrier_column)
+    for row in rows:
+        name = row[name_index] if name_index < len(row) else None
+        barriers = row[barrier_index] if barrier_index < len(row) else None
+        # Rows without a name and barriers are skipped
+        if name is None and barriers is None:
+            continue
+        yield ("" if name is None else str(name)), _split_cell(barriers)
+
+
+def iter_excel_rows(source, max_rows=STREAM_ROW_LIMIT):
+    """
+    Stream the first bowtie of the workbook as ("info", hazard, top_event), ("threat", name, barriers) and
+    ("consequence", name, barriers) tuples, using openpyxl in read-only mode.
+
+    An info tuple starts each top event, with None values when its sheet set has no Info sheet. A ValueError is raised
+    once more than max_rows threat and consequence rows have been read.
+    """
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        count = 0
+        number, bowtie = 1, 1
+        while number == 1 or sheet_names(number)[0] in workbook.sheetnames:
+            threats_name, consequences_name, info_name = sheet_names(number)
+            hazard = top_event = None
+            if info_name in workbook.sheetnames:
+                info = [row[1] if len(row) > 1 else None for row in workbook[info_name].iter_rows(max_row=3, values_only=True)]
+                info += [None] * (3 - len(info))
+                hazard, top_event = (None if v is None else str(v) for v in info[:2])
+                bowtie = _bowtie_number(info[2], bowtie)
+            # Sheet sets of further bowties follow those of the first one
+            if bowtie != 1 and number > 1:
+                break
+            yield "info", hazard, top_event
+
+            for kind, sheet_name, name_column, barrier_column in (
+                ("threat", threats_name, "Threat", "Preventive Barriers"),
+                ("consequence", consequences_name, "Consequence", "Mitigative Barriers"),
+            ):
+                for name, barriers in _iter_sheet(workbook, sheet_name, name_column, barrier_column):
+                    count += 1
+                    if max_rows is not None and count > max_rows:
+                        raise ValueError(f"Workbook has more than {max_rows} threat and consequence rows")
+                    yield kind, name, barriers
+            number += 1
+    finally:
+        workbook.close()
+
+
+def stream_excel(source, max_rows=STREAM_ROW_LIMIT, progress=None):
+    """
+    Build a bowtie_model.Hazard from a workbook streamed with iter_excel_rows.
+
+    The hazard and top event names are None when their sheet set has no Info sheet. If given, progress is called with the
+    number of rows read so far.
+    """
+    rows = iter_excel_rows(source, max_rows)
+    _, hazard_name, top_event_name = next(rows)
+    top_event = TopEvent(name=top_event_name)
+    hazard = Hazard(name=hazard_name, top_events=[top_event])
+
+    count = 0
+    for row in rows:
+        if row[0] == "info":
+            # Further top events of the bowtie start with their own info tuple
+            top_event = TopEvent(name=row[2])
+            hazard.top_events.append(top_event)
+            hazard.register(top_event, hazard)
+            continue
+        kind, name, barriers = row
+        if kind == "threat":
+            node = Threat(name=name, barriers=[Barrier(b) for b in barriers])
+            top_event.threats.append(node)
+        else:
+            node = Consequence(name=name, barriers=[Barrier(b) for b in barriers])
+            top_event.consequences.append(node)
+        hazard.register(node, top_event)
+        count += 1
+        if progress is not None and count % STREAM_PROGRESS_STEP == 0:
+            progress(count)
+    if progress is not None:
+        progress(count)
+    return hazard
+
+
+def _row(sheet, *values):
+    # Text is written as string cells, so names starting with "=" are not stored as formulas
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(sheet, value)
+        if isinstance(value, str):
+            cell.data_type = "s"
+        cells.append(cell)
+    return cells
+
+
+def write_excel(bowties, target):
+    """
+    Write bowtie_model.Hazard objects to a workbook in the import layout, one sheet set per top event.
+
+    The workbook is built with openpyxl in write-only mode, so rows are streamed to target (a path or a binary file
+    object) as they are written. Workbooks of several bowties carry the bowtie number in each Info sheet. Reading the
+    workbook back gives the same bowties, as long as no name contains `;` or leading or trailing whitespace.
+    """
+    bowties = list(bowties)
+    workbook = Workbook(write_only=True)
+    number = 0
+    for bowtie_number, bowtie in enumerate(bowties, start=1):
+        for top_event in bowtie.top_events:
+            number += 1
+            threats_name, consequences_name, info_name = sheet_names(number)
+            for sheet_name, header, branches in (
+                (threats_name, ("Threat", "Preventive Barriers"), top_event.threats),
+                (consequences_name, ("Consequence", "Mitigative Barriers"), top_event.consequences),
+            ):
+                sheet = workbook.create_sheet(sheet_name)
+                sheet.append(header)
+                for branch in branches:
+                    sheet.append(_row(sheet, branch.name, "; ".join(b.name for b in branch.barriers)))
+            info = workbook.create_sheet(info_name)
+            info.append(_row(info, "Hazard", bowtie.name))
+            info.append(_row(info, "Top Event", top_event.name))
+            if len(bowties) > 1:
+                info.append(("Bowtie", bowtie_number))
+    if number == 0:
+        raise ValueError("No top events to export")
+    workbook.save(target)
+
+
+def export_excel(bowties):
+    """Return the workbook of write_excel as bytes."""
+    buffer = io.BytesIO()
+    write_excel(bowties, buffer)
+    return buffer.getvalue()
@@ -0,0 +1,142 @@
+"""
+OpenAI chat client used by the Agent tab.
+
+Clients are cached per API key and configuration, so the connection pool each client keeps is reused across reruns
+and sessions. Requests use explicit timeouts and are retried with exponential backoff on connection errors, timeouts,
+rate limits and server errors. Completions are streamed from a background thread into a
+queue, so the request starts as soon as it is submitted and the caller only consumes text chunks.
+
+The configuration is read from environment variables. Point OPENAI_BASE_URL at mock_llm_server.py to run the app
+without the OpenAI API.
+"""
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+
+import openai
+from openai import OpenAI
+
+# Errors worth retrying: the request did not reach the model or the service asked us to come back later
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+# Worker threads running the streaming requests, shared by all sessions
+STREAM_WORKERS = 16
+
+_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="llm-stream")
+_DONE = object()
+
+
+@dataclass(frozen=True, slots=True)
+class LLMConfig:
+    model: str = "gpt-3.5-turbo"
+    base_url: str = None
+    timeout: float = 60.0
+    connect_timeout: float = 10.0
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+
+    @classmethod
+    def from_env(cls):
+        """Build the configuration from BOWTIE_LLM_* environment variables and OPENAI_BASE_URL."""
+        defaults = cls()
+        return cls(
+            model=os.environ.get("BOWTIE_LLM_MODEL", defaults.model),
+            base_url=os.environ.get("OPENAI_BASE_URL") or None,
+            timeout=float(os.environ.get("BOWTIE_LLM_TIMEOUT", defaults.timeout)),
+            connect_timeout=float(os.environ.get("BOWTIE_LLM_CONNECT_TIMEOUT", defaults.connect_timeout)),
+            max_retries=int(os.environ.get("BOWTIE_LLM_MAX_RETRIES", defaults.max_retries)),
+            backoff_base=float(os.environ.get("BOWTIE_LLM_BACKOFF_BASE", defaults.backoff_base)),
+            backoff_max=float(os.environ.get("BOWTIE_LLM_BACKOFF_MAX", defaults.backoff_max)),
+        )
+
+    def backoff(self, attempt):
+        """Return the delay before the given retry attempt: exponential with full jitter, capped at backoff_max."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+@lru_cache(maxsize=32)
+def get_client(api_key, config=LLMConfig()):
+    """Return the OpenAI client for the API key and configuration, creating it on first use."""
+    # Retries are handled by create_stream, so that the backoff is configurable
+    return OpenAI(
+        api_key=api_key,
+        base_url=config.base_url,
+        timeout=openai.Timeout(config.timeout, connect=config.connect_timeout),
+        max_retries=0,
+    )
+
+
+def create_stream(client, messages, config=LLMConfig(), **kwargs):
+    """Start a streaming chat completion, retrying with backoff until the response starts."""
+    for attempt in range(config.max_retries + 1):
+        try:
+            return client.chat.completions.create(model=config.model, messages=messages, stream=True, **kwargs)
+        except RETRYABLE_ERRORS:
+            if attempt == config.max_retries:
+                raise
+            time.sleep(config.backoff(attempt))
+
+
+def stream_chat(client, messages, config=LLMConfig(), on_usage=None, on_tool_call=None, **kwargs):
+    """
+    Start a streaming chat completion and return the generator of its text chunks.
+
+    The request is sent on a worker thread as soon as stream_chat is called and hands chunks over through a queue.
+    Errors of the request are raised by the generator. Closing the generator early closes the response on the worker
+    thread. If given, on_usage is called with the token usage reported at the end of the stream, and on_tool_call with
+    the index and function name of the call and each chunk of the function call arguments as they arrive.
+    """
+    if on_usage is not None:
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    chunks = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        # Function names arrive with the first chunk of each call only
+        tool_names = {}
+        try:
+            stream = create_stream(client, messages, config, **kwargs)
+            with stream:
+                for event in stream:
+                    if stop.is_set():
+                        break
+                    delta = event.choices[0].delta if event.choices else None
+                    if delta is not None and delta.content:
+                        chunks.put(delta.content)
+                    if delta is not None and delta.tool_calls and on_tool_call is not None:
+                        for call in delta.tool_calls:
+                            if call.function is None:
+                                continue
+                            if call.function.name:
+                                tool_names[call.index] = call.function.name
+                            if call.function.arguments:
+                                on_tool_call(call.index, tool_names.get(call.index), call.function.arguments)
+                    if on_usage is not None and getattr(event, "usage", None):
+                        on_usage(event.usage)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(_DONE)
+
+    def consume():
+        try:
+            while (item := chunks.get()) is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    _executor.submit(produce)
+    return consume()
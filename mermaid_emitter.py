@@ -0,0 +1,107 @@
+"""
+Mermaid.js code generation for bowtie diagrams.
+
+The diagram code is built from per-node fragments collected in a list and joined once. Nodes use the IDs of the bowtie
+model, are grouped into one subgraph per lane and are styled with class definitions, so the code grows by about one line
+per node. Fragments for a single threat or consequence branch are cached on their own content, so editing one branch
+only rebuilds that branch, and the complete diagram code is cached on a content hash of the diagram data plus the number
+of words per line. Both caches are shared by all sessions.
+"""
+from functools import lru_cache
+
+from shared_cache import SharedCache
+
+# Maximum number of complete diagrams kept in the code cache, and their maximum size in bytes
+CODE_CACHE_SIZE = 32
+CODE_CACHE_BYTES = 32 * 1024 * 1024
+
+_code_cache = SharedCache("mermaid_code", CODE_CACHE_SIZE, CODE_CACHE_BYTES)
+
+
+def wrap_text(text, num_words):
+    # Wrap the text output to the diagram nodes to improve readability
+    words = str(text).split()
+    return "<br>".join(" ".join(words[w:w + num_words]) for w in range(0, len(words), num_words))
+
+
+# Mermaid class definitions for the node styles
+CLASS_DEFS = [
+    "classDef hazard fill:#FFDE59,stroke:#000000,stroke-width:8px",
+    "classDef topEvent fill:#FEB84F",
+    "classDef threat fill:#504AFF,color:#FFFFFF",
+    "classDef consequence fill:#D53638,color:#FFFFFF",
+]
+
+
+@lru_cache(maxsize=4096)
+def _branch_fragment(branch_id, name, barriers, top_event_id, preventive, words_per_line):
+    # Node definitions and links of one threat or consequence branch. Barriers are (id, name) pairs in chain order.
+    node = f"{branch_id}({wrap_text(name, words_per_line)})"
+    barrier_nodes = "\n".join(f"{barrier_id}({wrap_text(barrier, words_per_line)})" for barrier_id, barrier in barriers)
+    barrier_ids = [barrier_id for barrier_id, _ in barriers]
+    chain = [branch_id, *barrier_ids, top_event_id] if preventive else [top_event_id, *barrier_ids, branch_id]
+    links = "\n".join(f"{a} --- {b}" for a, b in zip(chain, chain[1:]))
+    return node, barrier_nodes, links
+
+
+def _subgraph(name, label, lines):
+    return [f"subgraph {name}[{label}]", *lines, "end"] if lines else []
+
+
+def _generate(diagram, words_per_line):
+    # Nodes are identified by their model IDs, which are unique within the bowtie however many elements it has
+    top_events = diagram.top_events
+    threat_nodes, preventive_nodes, consequence_nodes, mitigative_nodes, links = [], [], [], [], []
+    threat_ids, consequence_ids = [], []
+
+    for top_event in reversed(top_events):
+        # Threats and preventive barriers
+        for threat in top_event.threats:
+            node, barrier_nodes, branch_links = _branch_fragment(
+                threat.id, threat.name, tuple((b.id, b.name) for b in threat.barriers), top_event.id, True, words_per_line
+            )
+            threat_nodes.append(node)
+            threat_ids.append(threat.id)
+            if barrier_nodes:
+                preventive_nodes.append(barrier_nodes)
+            links.append(branch_links)
+        # Consequences and mitigative barriers
+        for consequence in reversed(top_event.consequences):
+            node, barrier_nodes, branch_links = _branch_fragment(
+                consequence.id, consequence.name, tuple((b.id, b.name) for b in consequence.barriers), top_event.id, False,
+                words_per_line
+            )
+            consequence_nodes.append(node)
+            consequence_ids.append(consequence.id)
+            if barrier_nodes:
+                mitigative_nodes.append(barrier_nodes)
+            links.append(branch_links)
+
+    fragments = [
+        "flowchart LR",
+        "subgraph Hazard[Hazard]",
+        f"{diagram.id}({wrap_text(diagram.name, words_per_line)})",
+        *_subgraph("TopEvents", "Top Events", [f"{te.id}(({wrap_text(te.name, words_per_line)}))" for te in top_events]),
+        "end",
+        *_subgraph("Threats", "Threats", threat_nodes),
+        *_subgraph("PreventiveBarriers", "Preventive Barriers", preventive_nodes),
+        *_subgraph("Consequences", "Consequences", consequence_nodes),
+        *_subgraph("MitigativeBarriers", "Mitigative Barriers", mitigative_nodes),
+        *links,
+        *CLASS_DEFS,
+        f"class {diagram.id} hazard",
+    ]
+    for class_name, ids in (("topEvent", [te.id for te in top_events]), ("threat", threat_ids), ("consequence", consequence_ids)):
+        if ids:
+            fragments.append(f"class {','.join(ids)} {class_name}")
+    return "\n".join(fragments)
+
+
+def build_mermaid_code(diagram, words_per_line=3):
+    """Return the Mermaid flowchart code for a bowtie_model.Hazard, reusing cached output when the content is unchanged."""
+    return _code_cache.get_or_create((diagram.content_hash(), words_per_line), lambda: _generate(diagram, words_per_line))
+
+
+def branch_cache_info():
+    """Return the lru_cache statistics of the per-branch fragment cache."""
+    return _branch_fragment.cache_info()
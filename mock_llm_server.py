@@ -0,0 +1,125 @@
+"""
+Local mock of the OpenAI chat completions API for running the Agent tab without an API key.
+
+Serves POST /v1/chat/completions, both streaming (server-sent events) and non-streaming, and answers every request with
+the same reply. When the request offers tools, a `bowtie_data = {...}` part of the reply is sent as a call of the first
+tool instead of as text, and a `<tool name> = {...}` part as a call of that tool. Start it and point the app at it:
+
+    python mock_llm_server.py --port 8001
+    OPENAI_BASE_URL=http://localhost:8001/v1 streamlit run app.py
+
+Any API key is accepted.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "Thanks. Here is the bowtie so far.\n"
+    'bowtie_data = { "hazard": "Flammable Gas", "top_events": [ { "top_event": "Loss of containment", '
+    '"threats": [ { "threat": "Corrosion", "preventive_barriers": ["Inspection program"] } ], '
+    '"consequences": [ { "consequence": "Fire", "mitigative_barriers": ["Emergency shutdown"] } ] } ] }'
+)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    reply = DEFAULT_REPLY
+    chunk_size = 16
+    chunk_delay = 0.01
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = request.get("model", "mock")
+        completion = {"id": "chatcmpl-mock", "created": int(time.time()), "model": model}
+
+        text, arguments, tool_name = self.reply, None, None
+        tool_names = [tool["function"]["name"] for tool in request.get("tools") or []]
+        # `bowtie_data = ...` goes to the first tool, `<tool name> = ...` to the tool of that name
+        for marker, name in [("bowtie_data", tool_names[0] if tool_names else None), *zip(tool_names, tool_names)]:
+            start = text.find(f"{marker} =")
+            if name and start != -1:
+                text, arguments, tool_name = text[:start].rstrip(), text[start + len(marker) + 2:].strip(), name
+                break
+
+        if not request.get("stream"):
+            message = {"role": "assistant", "content": text}
+            if arguments is not None:
+                message["tool_calls"] = [{"id": "call_mock", "type": "function",
+                                          "function": {"name": tool_name, "arguments": arguments}}]
+            body = json.dumps({
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "tool_calls" if arguments is not None else "stop",
+                             "message": message}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        deltas = [{"content": text[i:i + self.chunk_size]} for i in range(0, len(text), self.chunk_size)]
+        if arguments is not None:
+            # The first chunk of the call carries its id and function name
+            calls = [{"index": 0, "function": {"arguments": arguments[i:i + self.chunk_size]}}
+                     for i in range(0, len(arguments), self.chunk_size)]
+            calls[0].update(id="call_mock", type="function")
+            calls[0]["function"]["name"] = tool_name
+            deltas += [{"tool_calls": [call]} for call in calls]
+        try:
+            for index, delta in enumerate(deltas):
+                if index == 0:
+                    delta = {"role": "assistant", **delta}
+                self._send_event({**completion, "object": "chat.completion.chunk",
+                                  "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                time.sleep(self.chunk_delay)
+            self._send_event({**completion, "object": "chat.completion.chunk",
+                              "choices": [{"index": 0, "delta": {},
+                                           "finish_reason": "tool_calls" if arguments is not None else "stop"}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                # Rough token counts, enough to exercise the usage reporting of the client
+                prompt_tokens = sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4
+                completion_tokens = len(self.reply) // 4
+                self._send_event({**completion, "object": "chat.completion.chunk", "choices": [],
+                                  "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                            "total_tokens": prompt_tokens + completion_tokens}})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early
+            pass
+
+    def _send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8001, reply=DEFAULT_REPLY):
+    """Return the mock server bound to the port. Call serve_forever() to run it and shutdown() to stop it."""
+    handler = type("Handler", (MockHandler,), {"reply": reply})
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server.")
+    parser.add_argument("--port", type=int, default=8001, help="Port to listen on (default: 8001)")
+    parser.add_argument("--reply", default=DEFAULT_REPLY, help="Reply returned for every request")
+    args = parser.parse_args()
+    server = serve(args.port, args.reply)
+    print(f"Mock OpenAI API listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Timing spans, per-rerun totals, LLM reply timings and cache hit rates for the app's debug panel.
+
+A Profiler belongs to one session. Code is timed with nested spans, and spans are grouped into runs: a full script run
+is started and ended explicitly, while a fragment rerun has no such hook, so a span opened outside any run starts a
+fragment run that ends with it. The last RUN_HISTORY runs are kept with their spans, and totals per span name and run
+kind cover the whole session. Streamed LLM replies are measured with a StreamTimer for the time to the first token and
+the token rate.
+
+Everything can be exported as JSON or in the Prometheus text exposition format, together with the hit and miss counts
+of the app's caches.
+"""
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Number of runs and LLM replies kept per session
+RUN_HISTORY = 50
+LLM_HISTORY = 20
+
+# Prefix of the exported Prometheus metric names
+METRIC_PREFIX = "bowtie"
+
+
+def _add(totals, name, seconds):
+    # totals maps a name to [count, total seconds, maximum seconds]
+    entry = totals.setdefault(name, [0, 0.0, 0.0])
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds)
+
+
+class StreamTimer:
+    """Measures a streamed reply: the time to its first chunk and its total time, both from the creation of the timer."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first = None
+        self.end = None
+
+    def mark(self):
+        """Record the arrival of a chunk; also call it for chunks that are not text, like function call arguments."""
+        if self.first is None:
+            self.first = time.perf_counter()
+
+    def watch(self, chunks):
+        """Yield the text chunks, marking each one and the end of the stream."""
+        for chunk in chunks:
+            self.mark()
+            yield chunk
+        self.end = time.perf_counter()
+
+    @property
+    def time_to_first_token(self):
+        return self.first - self.start if self.first is not None else None
+
+    @property
+    def seconds(self):
+        return self.end - self.start if self.end is not None else None
+
+
+class Profiler:
+    def __init__(self, history=RUN_HISTORY):
+        self.runs = deque(maxlen=history)
+        self.llm = deque(maxlen=LLM_HISTORY)
+        # Totals per span name and per run kind, as [count, total seconds, maximum seconds]
+        self.span_totals = {}
+        self.run_totals = {}
+        # Number of LLM replies of the session, live and cached
+        self.llm_replies = {False: 0, True: 0}
+        self._run = None
+        self._start = None
+        self._depth = 0
+
+    def start_run(self, kind="full"):
+        """Start a run. A run left open, e.g. by a rerun interrupting the script, is ended first."""
+        if self._run is not None:
+            self._run["interrupted"] = True
+            self.end_run()
+        self._run = {"kind": kind, "started": time.time(), "seconds": None, "interrupted": False, "spans": []}
+        self._start = time.perf_counter()
+        self._depth = 0
+
+    def end_run(self):
+        """End the current run, if any, and add it to the history and totals."""
+        run = self._run
+        if run is None:
+            return
+        run["seconds"] = time.perf_counter() - self._start
+        self._run = None
+        self.runs.append(run)
+        _add(self.run_totals, run["kind"], run["seconds"])
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed code as a span of the current run, starting a fragment run if no run is open."""
+        implicit = self._run is None
+        if implicit:
+            self.start_run("fragment")
+        run = self._run
+        start = time.perf_counter()
+        entry = {"name": name, "depth": self._depth, "offset": start - self._start, "seconds": None}
+        run["spans"].append(entry)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            entry["seconds"] = time.perf_counter() - start
+            _add(self.span_totals, name, entry["seconds"])
+            # A run started since (after an interrupted one) has reset the depth already
+            if self._run is run:
+                self._depth -= 1
+                if implicit:
+                    self.end_run()
+
+    def record_llm(self, timer, tokens, cached=False):
+        """Record a completed reply measured by a StreamTimer with its number of completion tokens."""
+        if timer.seconds is None:
+            return
+        ttft = timer.time_to_first_token
+        # The token rate counts the generation after the first token, when the reply arrives in several chunks
+        generation = timer.seconds - ttft if ttft is not None and timer.seconds > ttft else timer.seconds
+        self.llm_replies[bool(cached)] += 1
+        self.llm.append({
+            "started": time.time() - timer.seconds,
+            "time_to_first_token": ttft,
+            "seconds": timer.seconds,
+            "tokens": tokens,
+            "tokens_per_second": tokens / generation if tokens and generation > 0 else None,
+            "cached": cached,
+        })
+
+    def summary(self, caches=()):
+        """Return the session's runs, totals, LLM replies and the given cache statistics as a dictionary."""
+        return {
+            "runs": list(self.runs),
+            "run_totals": _totals(self.run_totals, "kind"),
+            "span_totals": _totals(self.span_totals, "span"),
+            "llm": list(self.llm),
+            "caches": list(caches),
+        }
+
+    def to_json(self, caches=()):
+        """Return the summary as JSON text."""
+        return json.dumps(self.summary(caches), indent=2)
+
+    def to_prometheus(self, caches=()):
+        """Return the totals, the last LLM reply and the cache statistics in the Prometheus text exposition format."""
+        metrics = []
+
+        def metric(name, kind, help_text, samples):
+            metrics.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            metrics.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                metrics.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value!r}" if label_text
+                               else f"{METRIC_PREFIX}_{name} {value!r}")
+
+        for label, totals, what in (("span", self.span_totals, "span"), ("kind", self.run_totals, "run")):
+            metric(f"{what}_seconds_total", "counter", f"Total time of each {what} in seconds.",
+                   [({label: name}, entry[1]) for name, entry in totals.items()])
+            metric(f"{what}_count_total", "counter", f"Number of times each {what} was timed.",
+                   [({label: name}, entry[0]) for name, entry in totals.items()])
+            metric(f"{what}_seconds_max", "gauge", f"Longest time of each {what} in seconds.",
+                   [({label: name}, entry[2]) for name, entry in totals.items()])
+
+        metric("llm_replies_total", "counter", "Number of LLM replies, live or from the response cache.",
+               [({"cached": str(cached).lower()}, count) for cached, count in self.llm_replies.items()])
+        live = [r for r in self.llm if not r["cached"]]
+        if live and live[-1]["time_to_first_token"] is not None:
+            metric("llm_time_to_first_token_seconds", "gauge", "Time to the first token of the last live LLM reply.",
+                   [({}, live[-1]["time_to_first_token"])])
+        if live and live[-1]["tokens_per_second"] is not None:
+            metric("llm_tokens_per_second", "gauge", "Completion tokens per second of the last live LLM reply.",
+                   [({}, live[-1]["tokens_per_second"])])
+
+        caches = list(caches)
+        metric("cache_hits_total", "counter", "Cache hits.", [({"cache": c["cache"]}, c["hits"]) for c in caches])
+        metric("cache_misses_total", "counter", "Cache misses.", [({"cache": c["cache"]}, c["misses"]) for c in caches])
+        metric("cache_hit_ratio", "gauge", "Share of cache lookups that were hits.",
+               [({"cache": c["cache"]}, c["hit_rate"]) for c in caches if c["hit_rate"] is not None])
+        metric("cache_entries", "gauge", "Entries in the cache.", [({"cache": c["cache"]}, c["size"]) for c in caches])
+        metric("cache_bytes", "gauge", "Estimated size of the cache entries in bytes.",
+               [({"cache": c["cache"]}, c["bytes"]) for c in caches if c.get("bytes") is not None])
+        return "\n".join(metrics) + "\n"
+
+
+def _totals(totals, label):
+    return [
+        {label: name, "count": count, "seconds": seconds, "mean_seconds": seconds / count, "max_seconds": longest}
+        for name, (count, seconds, longest) in sorted(totals.items(), key=lambda item: -item[1][1])
+    ]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def cache_stats(sources):
+    """
+    Return the statistics of named caches as a list of dictionaries with hits, misses, hit rate, size and maximum size,
+    and the size and maximum size in bytes where known.
+
+    sources maps cache names to their statistics: functools.lru_cache info, or a dictionary with hits and misses, the
+    size as "size" or "entries", and optionally "bytes" and "max_bytes".
+    """
+    stats = []
+    for name, info in sources.items():
+        if hasattr(info, "_asdict"):
+            info = {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+        lookups = info["hits"] + info["misses"]
+        stats.append({
+            "cache": name,
+            "hits": info["hits"],
+            "misses": info["misses"],
+            "hit_rate": info["hits"] / lookups if lookups else None,
+            "size": info.get("size", info.get("entries", 0)),
+            "max_size": info.get("max_size"),
+            "bytes": info.get("bytes"),
+            "max_bytes": info.get("max_bytes"),
+        })
+    return stats
@@ -0,0 +1,150 @@
+"""
+On-disk cache of agent replies for repeated prompts.
+
+Replies are stored per (model, system prompt hash, message history hash), one JSON file per entry, together with the
+function calls of the reply. A repeated prompt is answered from the cache and replayed chunk by chunk, so the app shows
+it through the same streaming path as a live reply. Entries expire after a time to live, and the least recently used
+entries are evicted beyond the maximum number of entries. Hit and miss counts are kept per cache directory for the
+lifetime of the process.
+
+The cache is off unless BOWTIE_RESPONSE_CACHE_DIR is set; BOWTIE_RESPONSE_CACHE_TTL (seconds) and
+BOWTIE_RESPONSE_CACHE_SIZE (entries) tune it.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from llm_client import LLMConfig, stream_chat
+
+# Default time to live of an entry in seconds, and maximum number of entries
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+RESPONSE_CACHE_SIZE = 256
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, model, messages, tools=None):
+        """Return the cache key of a request: the model, the system prompt and tools, and the remaining messages."""
+        system, history = messages[:1], messages[1:]
+        return _digest([model, _digest([system, tools]), _digest(history)])
+
+    def get(self, key):
+        """Return the cached entry for the key, or None. Counts the lookup as a hit or a miss."""
+        path = self.directory / f"{key}.json"
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and time.time() - entry["created"] > self.ttl:
+            path.unlink(missing_ok=True)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is not None:
+            # The modification time records the last use for the LRU eviction
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return entry
+
+    def put(self, key, chunks, tool_calls):
+        """Store the text chunks and function calls of a reply and evict expired and least recently used entries."""
+        path = self.directory / f"{key}.json"
+        temporary = path.with_suffix(f".{threading.get_ident()}.tmp")
+        temporary.write_text(json.dumps({"created": time.time(), "chunks": chunks, "tool_calls": tool_calls}),
+                             encoding="utf-8")
+        os.replace(temporary, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        now = time.time()
+        for path in self.directory.glob("*.json"):
+            try:
+                mtime = path.stat().st_mtime
+            except OSError:
+                continue
+            # Entries are never used after their time to live, so their last use is at least that old
+            if now - mtime > self.ttl:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((mtime, path))
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            path.unlink(missing_ok=True)
+
+    def stats(self):
+        """Return the hit and miss counts and the number of stored entries."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": sum(1 for _ in self.directory.glob("*.json"))}
+
+    def stream_chat(self, client, messages, config=LLMConfig(), on_usage=None, on_tool_call=None, **kwargs):
+        """
+        Like llm_client.stream_chat, answering repeated requests from the cache.
+
+        Returns the generator of text chunks and whether the reply comes from the cache. Cached function calls are
+        passed to on_tool_call before the text is replayed. A live reply is stored once it has been read completely.
+        """
+        key = self.key(config.model, messages, kwargs.get("tools"))
+        entry = self.get(key)
+        if entry is not None:
+            if on_tool_call is not None:
+                for index, name, arguments in entry["tool_calls"]:
+                    on_tool_call(index, name, arguments)
+            return iter(entry["chunks"]), True
+
+        tool_calls = []
+
+        def record_tool_call(index, name, arguments):
+            tool_calls.append([index, name, arguments])
+            if on_tool_call is not None:
+                on_tool_call(index, name, arguments)
+
+        stream = stream_chat(client, messages, config, on_usage, record_tool_call, **kwargs)
+
+        def record():
+            chunks = []
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+            self.put(key, chunks, tool_calls)
+
+        return record(), False
+
+
+@lru_cache(maxsize=8)
+def get_response_cache(directory, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE):
+    """Return the response cache for the directory, shared by all sessions so the counters cover all of them."""
+    return ResponseCache(directory, ttl, max_entries)
+
+
+def response_cache_from_env():
+    """Return the response cache configured by the BOWTIE_RESPONSE_CACHE_* environment variables, or None."""
+    directory = os.environ.get("BOWTIE_RESPONSE_CACHE_DIR")
+    if not directory:
+        return None
+    return get_response_cache(
+        directory,
+        float(os.environ.get("BOWTIE_RESPONSE_CACHE_TTL", RESPONSE_CACHE_TTL)),
+        int(os.environ.get("BOWTIE_RESPONSE_CACHE_SIZE", RESPONSE_CACHE_SIZE)),
+    )
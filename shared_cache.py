@@ -0,0 +1,174 @@
+"""
+Process-wide caches shared by all sessions, and memory accounting per cache and per session.
+
+Streamlit runs every session on its own thread of one process, so module-level caches serve all sessions: a workbook,
+diagram code, layout or rendered file computed for one workshop is reused by the others. A SharedCache is a least
+recently used cache guarded by a lock and capped both by its number of entries and by the estimated size of its values
+in bytes. Cached values are shared between sessions and must not be modified; callers that edit a value copy it first.
+
+Every SharedCache is registered by name for the memory report. Sessions report the estimated size of their session
+state with report_session, at most every SESSION_REPORT_INTERVAL seconds, and reports of sessions that stopped
+reporting expire after SESSION_REPORT_TTL seconds.
+"""
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, deque
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Seconds between two memory reports of a session, and after which the report of an inactive session is dropped
+SESSION_REPORT_INTERVAL = 30
+SESSION_REPORT_TTL = 3600
+
+_caches = {}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Objects that are shared by the whole process and not counted as part of a value
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+_LEAF_TYPES = (str, bytes, bytearray, int, float, complex, bool, type(None))
+
+
+def deep_size(value, seen=None):
+    """
+    Return the estimated memory of the value and everything it references, in bytes.
+
+    Objects whose id is in seen are not counted, and counted objects are added to it, so several values can be measured
+    without counting shared objects twice.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, _LEAF_TYPES):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        else:
+            if isinstance(getattr(obj, "__dict__", None), dict):
+                stack.append(obj.__dict__)
+            for slot in getattr(type(obj), "__slots__", ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return size
+
+
+class SharedCache:
+    """A thread-safe LRU cache capped by entries and estimated bytes. Values larger than max_bytes are not stored."""
+
+    def __init__(self, name, max_entries, max_bytes, sizeof=deep_size):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        # Values and their sizes by key, least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def get(self, key, default=None):
+        """Return the cached value for the key, or default. Counts the lookup as a hit or a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        """Store the value, evicting the least recently used entries beyond the caps, and return it."""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+        return value
+
+    def get_or_create(self, key, create):
+        """Return the cached value for the key, calling create() and storing its result on a miss."""
+        value = self.get(key)
+        if value is None:
+            # Computed outside the lock, so other sessions are not blocked; a concurrent miss computes it twice
+            value = self.put(key, create())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self):
+        """Return the hits, misses, number of entries and bytes, and the caps."""
+        with self._lock:
+            return {
+                "hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_entries,
+                "bytes": self._bytes, "max_bytes": self.max_bytes,
+            }
+
+
+def shared_caches():
+    """Return the info of every SharedCache by name."""
+    return {name: cache.info() for name, cache in _caches.items()}
+
+
+def report_session(session_id, state, interval=SESSION_REPORT_INTERVAL):
+    """
+    Record the estimated size of each item of a session's state, unless the session reported less than interval
+    seconds ago. Items referencing the same objects are counted once, in the order of the state.
+    """
+    now = time.time()
+    with _sessions_lock:
+        previous = _sessions.get(session_id)
+        if previous is not None and now - previous["reported"] < interval:
+            return
+    seen = set()
+    items = {str(key): deep_size(value, seen) for key, value in list(state.items())}
+    with _sessions_lock:
+        _sessions[session_id] = {"reported": now, "bytes": sum(items.values()), "items": items}
+        for stale in [s for s, report in _sessions.items() if now - report["reported"] > SESSION_REPORT_TTL]:
+            del _sessions[stale]
+
+
+def session_reports():
+    """Return the memory reports of the active sessions as a dictionary by session ID, largest first."""
+    with _sessions_lock:
+        return dict(sorted(_sessions.items(), key=lambda item: -item[1]["bytes"]))
+
+
+def process_memory():
+    """Return the current and peak resident memory of the process in bytes, None where the platform does not tell."""
+    current = peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * (resource.getpagesize() if resource is not None else 4096)
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {"rss": current, "peak_rss": peak}
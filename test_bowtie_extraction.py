@@ -0,0 +1,57 @@
+"""Patches of the agent's replies applied through the extractor and the bowtie model."""
+import json
+
+import pytest
+
+from bowtie_extraction import PATCH_TOOL, BowtieExtractor, ExtractionError
+from bowtie_model import Hazard
+
+BOWTIE = {
+    "hazard": "Flammable gas",
+    "top_events": [{
+        "top_event": "Loss of containment",
+        "threats": [{"threat": "Corrosion", "preventive_barriers": ["Inspection"]}],
+        "consequences": [{"consequence": "Fire", "mitigative_barriers": ["Emergency shutdown"]}],
+    }],
+}
+
+
+def patched(bowtie, *calls):
+    extractor = BowtieExtractor()
+    for index, operations in enumerate(calls):
+        extractor.feed_arguments(index, PATCH_TOOL["function"]["name"], json.dumps({"operations": operations}))
+    return extractor.apply(bowtie)
+
+
+def added_threat(bowtie, barriers):
+    top_event = bowtie.top_events[0]
+    operation = {"op": "add", "parent": top_event.id, "kind": "threat", "name": "Overpressure", "barriers": barriers}
+    return patched(bowtie, [operation]).top_events[0].threats[-1]
+
+
+@pytest.mark.parametrize("barriers", [["Relief valve"], "Relief valve", "Relief valve; "])
+def test_added_barriers(barriers):
+    threat = added_threat(Hazard.from_dict(BOWTIE), barriers)
+    assert [b.name for b in threat.barriers] == ["Relief valve"]
+
+
+def test_barriers_separated_by_semicolons():
+    threat = added_threat(Hazard.from_dict(BOWTIE), "Relief valve; Pressure alarm")
+    assert [b.name for b in threat.barriers] == ["Relief valve", "Pressure alarm"]
+
+
+def test_model_rejects_barriers_that_are_not_a_list():
+    bowtie = Hazard.from_dict(BOWTIE)
+    operation = {"op": "add", "parent": bowtie.top_events[0].id, "kind": "threat", "name": "Overpressure",
+                 "barriers": "Relief valve"}
+    with pytest.raises(ValueError):
+        bowtie.apply_patch([operation])
+    assert bowtie.to_dict() == BOWTIE
+
+
+def test_failing_call_leaves_bowtie_unchanged():
+    bowtie = Hazard.from_dict(BOWTIE)
+    rename = {"op": "rename", "id": bowtie.top_events[0].threats[0].id, "name": "External corrosion"}
+    with pytest.raises(ExtractionError):
+        patched(bowtie, [rename], [{"op": "remove", "id": "X99"}])
+    assert bowtie.to_dict() == BOWTIE
@@ -0,0 +1,100 @@
+"""Round trips of bowties through the Excel export and both Excel imports."""
+import io
+
+import pytest
+from openpyxl import load_workbook
+
+from bowtie_model import Hazard
+from excel_io import export_excel, import_excel, import_workbook, parse_workbook, stream_excel
+
+
+def bowtie(hazard, *top_events):
+    return Hazard.from_dict({"hazard": hazard, "top_events": list(top_events)})
+
+
+def top_event(name, threats, consequences):
+    return {
+        "top_event": name,
+        "threats": [{"threat": t, "preventive_barriers": barriers} for t, barriers in threats],
+        "consequences": [{"consequence": c, "mitigative_barriers": barriers} for c, barriers in consequences],
+    }
+
+
+SINGLE = bowtie(
+    "Flammable gas",
+    top_event("Loss of containment", [("Corrosion", ["Inspection", "Coating"])], [("Fire", ["Emergency shutdown"])]),
+)
+MULTI_TOP_EVENT = bowtie(
+    "Pressurised vessel",
+    top_event("Overpressure", [("Blocked outlet", ["Relief valve"]), ("Fire exposure", [])], [("Rupture", ["Bund"])]),
+    top_event("Vessel collapse", [("Vacuum", ["Vacuum breaker", "Procedure"])], [("Spill", [])]),
+)
+MULTI_BOWTIE = [
+    SINGLE,
+    MULTI_TOP_EVENT,
+    bowtie("Toxic liquid", top_event("Leak", [("Seal failure", ["Maintenance"])], [("Exposure", ["PPE", "Alarm"])])),
+]
+
+
+@pytest.mark.parametrize("bowties", [[SINGLE], [MULTI_TOP_EVENT], MULTI_BOWTIE], ids=["single", "multi_top_event", "multi_bowtie"])
+def test_pandas_round_trip(bowties):
+    data = export_excel(bowties)
+    assert parse_workbook(data) == [b.to_dict() for b in bowties]
+    assert import_workbook(data) == [b.to_dict() for b in bowties]
+    assert import_excel(data) == bowties[0].to_dict()
+
+
+@pytest.mark.parametrize("bowties", [[SINGLE], [MULTI_TOP_EVENT], MULTI_BOWTIE], ids=["single", "multi_top_event", "multi_bowtie"])
+def test_streaming_round_trip(bowties):
+    # The streaming import reads the first bowtie of the workbook
+    assert stream_excel(io.BytesIO(export_excel(bowties))).to_dict() == bowties[0].to_dict()
+
+
+def test_export_round_trips_again():
+    imported = parse_workbook(export_excel(MULTI_BOWTIE))
+    assert parse_workbook(export_excel([Hazard.from_dict(b) for b in imported])) == imported
+
+
+def test_formula_like_names_are_text():
+    formulas = bowtie("=1+1", top_event("=SUM(A1:A3)", [("=HYPERLINK(\"x\")", ["=2", "+3"])], [("-4", ["@A1"])]))
+    data = export_excel([formulas])
+    assert parse_workbook(data) == [formulas.to_dict()]
+    assert stream_excel(io.BytesIO(data)).to_dict() == formulas.to_dict()
+
+
+def test_export_without_top_events_fails():
+    with pytest.raises(ValueError):
+        export_excel([Hazard.from_dict({"hazard": "Empty", "top_events": []})])
+
+
+def test_sheet_set_without_info_sheet():
+    # A later sheet set without its Info sheet belongs to the bowtie before it and has no top event name
+    buffer = io.BytesIO(export_excel([MULTI_TOP_EVENT]))
+    workbook = load_workbook(buffer)
+    del workbook["Info 2"]
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    data = buffer.getvalue()
+
+    expected = MULTI_TOP_EVENT.to_dict()
+    expected["top_events"][1]["top_event"] = None
+    assert parse_workbook(data) == [expected]
+    assert stream_excel(io.BytesIO(data)).to_dict() == expected
+
+
+def test_blank_rows_are_skipped():
+    # Blank rows between and after the branches give no empty threats or consequences in either import
+    buffer = io.BytesIO(export_excel([MULTI_TOP_EVENT]))
+    workbook = load_workbook(buffer)
+    workbook["Threats"].insert_rows(3)
+    workbook["Threats"].append(())
+    workbook["Consequences 2"].append((None, None, "note"))
+    workbook["Consequences 2"].append(("Fire", None))
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    data = buffer.getvalue()
+
+    expected = MULTI_TOP_EVENT.to_dict()
+    expected["top_events"][1]["consequences"].append({"consequence": "Fire", "mitigative_barriers": []})
+    assert parse_workbook(data) == [expected]
+    assert stream_excel(io.BytesIO(data)).to_dict() == expected
@@ -0,0 +1,162 @@
+"""
+Background rendering of small bowtie previews for the library gallery.
+
+Previews are drawn with the Matplotlib export renderer at a reduced resolution on a pool of worker threads, so saving
+a bowtie to the library never waits for its preview. They are stored in a content-addressed cache: one file per content
+hash and format, so a bowtie is rendered once however many library entries, versions or sessions share its content.
+The least recently used files are evicted when the cache grows beyond its size limit.
+
+The cache directory is .bowtie_thumbnails in the working directory unless BOWTIE_THUMBNAIL_DIR is set;
+BOWTIE_THUMBNAIL_CACHE_MB limits its size.
+"""
+import copy
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from bowtie_export import EXPORT_FORMATS, render_bowtie
+
+THUMBNAIL_DIR = ".bowtie_thumbnails"
+# Maximum size of the cache directory in bytes
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024
+# Longest side of a preview in pixels (PNG) or points (SVG)
+THUMBNAIL_SIZE = 480
+# Worker threads rendering previews, and maximum number of queued renders; further requests are dropped and retried
+# when the preview is next asked for
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_QUEUE = 64
+
+
+def render_thumbnail(diagram, fmt="png", size=THUMBNAIL_SIZE):
+    """Render a preview of the bowtie diagram whose longest side is size pixels, and return the file contents."""
+    if fmt not in ("png", "svg"):
+        raise ValueError(f"Unsupported thumbnail format '{fmt}'")
+    # Figures are at least 8 inches wide, so previews are always below the export resolution; previews of large
+    # bowties leave out the labels
+    return render_bowtie(diagram, fmt, max_pixels=size)
+
+
+class ThumbnailCache:
+    """Content-addressed preview files, evicted least recently used first beyond max_bytes."""
+
+    def __init__(self, directory, max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def _path(self, content_hash, fmt):
+        return self.directory / f"{content_hash}.{fmt}"
+
+    def get(self, content_hash, fmt="png"):
+        """Return the stored preview, or None."""
+        path = self._path(content_hash, fmt)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        # The modification time records the last use for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, content_hash, fmt, data):
+        """Store a preview and evict the least recently used ones beyond the size limit."""
+        path = self._path(content_hash, fmt)
+        temporary = path.with_suffix(f".{threading.get_ident()}.tmp")
+        temporary.write_bytes(data)
+        os.replace(temporary, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.iterdir():
+            if path.suffix[1:] not in EXPORT_FORMATS:
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+class ThumbnailRenderer:
+    """Renders previews into a ThumbnailCache on a pool of worker threads."""
+
+    def __init__(self, cache, workers=THUMBNAIL_WORKERS, max_pending=THUMBNAIL_QUEUE):
+        self.cache = cache
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        # Futures of the queued and running renders by (content hash, format), and the renders that failed; those are
+        # not retried until the process restarts
+        self._pending = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def submit(self, diagram, fmt="png"):
+        """
+        Queue a preview of the bowtie unless it is stored, queued or failed already, and return the future of the render
+        or None. The bowtie is copied, so it can be edited while the preview renders.
+        """
+        content_hash = diagram.content_hash()
+        key = (content_hash, fmt)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if key in self._failed:
+                return None
+            if len(self._pending) >= self.max_pending or self.cache.get(content_hash, fmt) is not None:
+                return None
+            future = self._pending[key] = self._executor.submit(self._render, copy.deepcopy(diagram), content_hash, fmt)
+        return future
+
+    def _render(self, diagram, content_hash, fmt):
+        try:
+            data = render_thumbnail(diagram, fmt)
+            self.cache.put(content_hash, fmt, data)
+            return data
+        except Exception:
+            with self._lock:
+                self._failed.add((content_hash, fmt))
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop((content_hash, fmt), None)
+
+    def get(self, content_hash, fmt="png"):
+        """Return the stored preview for the content hash, or None while it is not rendered."""
+        return self.cache.get(content_hash, fmt)
+
+    def failed(self, content_hash, fmt="png"):
+        """Return whether rendering the preview for the content hash failed."""
+        with self._lock:
+            return (content_hash, fmt) in self._failed
+
+    def pending(self):
+        """Return the number of queued and running renders."""
+        with self._lock:
+            return len(self._pending)
+
+
+@lru_cache(maxsize=8)
+def get_thumbnails(directory=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES):
+    """Return the preview renderer for the cache directory, shared by all sessions of the process."""
+    return ThumbnailRenderer(ThumbnailCache(directory, max_bytes))
+
+
+def thumbnails_from_env():
+    """Return the preview renderer configured by the BOWTIE_THUMBNAIL_* environment variables."""
+    max_megabytes = os.environ.get("BOWTIE_THUMBNAIL_CACHE_MB")
+    return get_thumbnails(
+        os.environ.get("BOWTIE_THUMBNAIL_DIR") or THUMBNAIL_DIR,
+        int(float(max_megabytes) * 1024 * 1024) if max_megabytes else THUMBNAIL_CACHE_BYTES,
+    )